@@ -6,7 +6,6 @@ from pathlib import Path
 from PIL import Image
 import pandas as pd
 from core.chatbot import ArcadiaAICore
-from core.deep_research import DeepResearchCore
 from utils.first_run import check_and_install_phi4
 
 # --- CONFIG ---
@@ -37,7 +36,7 @@ if "bot" not in st.session_state:
 # Inizializza DeepResearch
 if "deep_research" not in st.session_state:
     try:
-        st.session_state.deep_research = DeepResearchCore()
+        st.session_state.deep_research = st.session_state.bot.deep_research
     except Exception as e:
         st.error(f"❌ Errore caricamento DeepResearch: {e}")
 
@@ -87,6 +86,70 @@ def process_uploaded_file(uploaded_file):
     else:
         return {"type": "file", "content": uploaded_file.read(), "name": uploaded_file.name}
 
+def message_html(role, content, timestamp="Ora"):
+    """HTML di un singolo messaggio della chat"""
+    role_class = "user" if role == "user" else "assistant"
+    return f"""
+        <div class="message {role_class}">
+            <div class="message-content">
+                {content}
+            </div>
+            <div class="message-time">
+                {timestamp}
+            </div>
+        </div>
+        """
+
+def show_queue_status(placeholder):
+    """Callback per mostrare la posizione in coda mentre il modello è occupato"""
+    def on_wait(position, estimated_wait):
+        placeholder.markdown(
+            message_html("assistant", f"⏳ In coda: posizione {position}, attesa stimata ~{estimated_wait:.0f}s"),
+            unsafe_allow_html=True
+        )
+    return on_wait
+
+def stream_reply(placeholder, chunks):
+    """Mostra la risposta man mano che arriva e restituisce il testo completo"""
+    text = ""
+    for delta in chunks:
+        text += delta
+        placeholder.markdown(message_html("assistant", text + " ▌"), unsafe_allow_html=True)
+    placeholder.markdown(message_html("assistant", text), unsafe_allow_html=True)
+    return text.strip()
+
+RESEARCH_STATUS = {
+    "search": "🔍 Ricerca delle fonti...",
+    "fetch": "📥 Lettura delle pagine...",
+    "rank": "📊 Valutazione delle fonti...",
+    "chunk": "📊 Selezione dei passaggi...",
+}
+
+def stream_research(placeholder, research, query):
+    """Mostra le fonti e poi il riassunto man mano che le fasi della ricerca procedono"""
+    sources = []
+    summary = ""
+    result = None
+    for event in research.research_stream(query):
+        stage = event["stage"]
+        if stage == "search":
+            sources.extend(event["sources"])
+        elif stage == "rank":
+            sources = event["pages"]
+        elif stage == "summarize":
+            summary = event["delta"] if event.get("replace") else summary + event["delta"]
+        elif stage == "done":
+            result = event["result"]
+            continue
+        if summary:
+            text = summary + " ▌"
+        else:
+            text = RESEARCH_STATUS.get(stage, "") + "\n" + "\n".join(f"- {s['title'] or s['url']}" for s in sources)
+        placeholder.markdown(message_html("assistant", text), unsafe_allow_html=True)
+    text = research.format(result)
+    placeholder.markdown(message_html("assistant", text), unsafe_allow_html=True)
+    return text
+
 # --- CSS PERSONALIZZATO ---
 st.markdown("""
 <style>
@@ -315,14 +378,29 @@ with st.sidebar:
     
     # Selezione modello
     if available_models:
+        bot_model = Path(st.session_state.bot.model_path).name
+        if "current_model" not in st.session_state:
+            st.session_state.current_model = bot_model
         selected_model = st.selectbox(
             "📦 Modello Locale:",
             available_models,
+            index=available_models.index(st.session_state.current_model) if st.session_state.current_model in available_models else 0,
             help="Seleziona il modello da utilizzare"
         )
-        if "current_model" not in st.session_state or st.session_state.current_model != selected_model:
+        if st.session_state.current_model != selected_model:
             st.session_state.current_model = selected_model
-            # Qui puoi ricaricare il modello se necessario
+            # Il nuovo modello viene caricato in background; la chat continua con quello attuale
+            try:
+                st.session_state.bot.switch_model(Path("models") / selected_model)
+            except Exception as e:
+                st.error(f"❌ Impossibile caricare {selected_model}: {e}")
+        swap_status = st.session_state.bot.swap_status
+        if swap_status == "loading":
+            st.info(f"⏳ Caricamento di {selected_model} in background...")
+        elif swap_status.startswith("error"):
+            st.error(f"❌ Cambio modello fallito: {swap_status[len('error: '):]}")
+        else:
+            st.caption(f"In uso: {bot_model}")
     else:
         st.warning("⚠️ Nessun modello trovato in /models")
         st.info("Aggiungi file .gguf, .bin o .safetensors nella cartella models/")
@@ -398,6 +476,8 @@ with col1:
         processed_file = process_uploaded_file(uploaded_file)
         if processed_file not in st.session_state.uploaded_files:
             st.session_state.uploaded_files.append(processed_file)
+            if processed_file["type"] == "text":
+                st.session_state.bot.indicizza_documento(processed_file["name"], processed_file["content"])
             st.success(f"✅ {uploaded_file.name} caricato!")
             st.rerun()
 
@@ -454,18 +534,14 @@ with col2:
     st.markdown('<div class="messages-container">', unsafe_allow_html=True)
     
     for i, message in enumerate(st.session_state.messages):
-        role_class = "user" if message["role"] == "user" else "assistant"
-        
-        st.markdown(f"""
-        <div class="message {role_class}">
-            <div class="message-content">
-                {message["content"]}
-            </div>
-            <div class="message-time">
-                {message.get("timestamp", "Ora")}
-            </div>
-        </div>
-        """, unsafe_allow_html=True)
+        st.markdown(
+            message_html(message["role"], message["content"], message.get("timestamp", "Ora")),
+            unsafe_allow_html=True
+        )
+    
+    # Segnaposto per il nuovo messaggio e la risposta in streaming
+    user_placeholder = st.empty()
+    reply_placeholder = st.empty()
     
     st.markdown('</div>', unsafe_allow_html=True)
     
@@ -493,6 +569,7 @@ with col2:
                     "timestamp": timestamp
                 }
                 st.session_state.messages.append(user_message)
+                user_placeholder.markdown(message_html("user", user_input, timestamp), unsafe_allow_html=True)
                 
                 # Prepara il context con file caricati
                 context = user_input
@@ -504,48 +581,50 @@ with col2:
                             context += f"Contenuto: {file_info['content'][:500]}...\n"
                 
                 # Genera risposta basata sulla modalità
-                with st.spinner("🤖 Elaborando..."):
-                    try:
-                        if st.session_state.current_mode == "reasoning":
-                            # Modalità ragionamento
-                            reasoning_prompt = f"""
-                            Ragiona step-by-step per rispondere a questa domanda:
-                            
-                            {context}
-                            
-                            Struttura la tua risposta così:
-                            1. **Analisi**: Cosa mi viene chiesto
-                            2. **Ragionamento**: I passaggi logici
-                            3. **Conclusione**: La risposta finale
-                            """
-                            response = st.session_state.bot.rispondi(reasoning_prompt)
-                            
-                        elif st.session_state.current_mode == "research":
-                            # Modalità ricerca
-                            if hasattr(st.session_state, 'deep_research'):
-                                response = st.session_state.deep_research.research(context)
-                            else:
-                                response = "⚠️ DeepResearch non disponibile. Risposta standard:\n\n" + st.session_state.bot.rispondi(context)
+                reply_placeholder.markdown(message_html("assistant", "🤖 Elaborando..."), unsafe_allow_html=True)
+                on_wait = show_queue_status(reply_placeholder)
+                sampling = {"temperature": temperature, "max_tokens": max_tokens}
+                try:
+                    if st.session_state.current_mode == "reasoning":
+                        # Modalità ragionamento
+                        reasoning_prompt = f"""
+                        Ragiona step-by-step per rispondere a questa domanda:
                         
-                        else:
-                            # Modalità normale
-                            response = st.session_state.bot.rispondi(context)
+                        {context}
                         
-                        # Aggiungi risposta assistant
-                        assistant_message = {
-                            "role": "assistant",
-                            "content": response,
-                            "timestamp": pd.Timestamp.now().strftime("%H:%M")
-                        }
-                        st.session_state.messages.append(assistant_message)
+                        Struttura la tua risposta così:
+                        1. **Analisi**: Cosa mi viene chiesto
+                        2. **Ragionamento**: I passaggi logici
+                        3. **Conclusione**: La risposta finale
+                        """
+                        response = stream_reply(reply_placeholder, st.session_state.bot.rispondi_stream(reasoning_prompt, on_wait=on_wait, **sampling))
                         
-                    except Exception as e:
-                        error_message = {
-                            "role": "assistant",
-                            "content": f"❌ Errore durante l'elaborazione: {str(e)}",
-                            "timestamp": pd.Timestamp.now().strftime("%H:%M")
-                        }
-                        st.session_state.messages.append(error_message)
+                    elif st.session_state.current_mode == "research":
+                        # Modalità ricerca
+                        if hasattr(st.session_state, 'deep_research'):
+                            response = stream_research(reply_placeholder, st.session_state.deep_research, user_input)
+                        else:
+                            response = "⚠️ DeepResearch non disponibile. Risposta standard:\n\n" + stream_reply(reply_placeholder, st.session_state.bot.rispondi_stream(context, on_wait=on_wait, **sampling))
+                    
+                    else:
+                        # Modalità normale
+                        response = stream_reply(reply_placeholder, st.session_state.bot.rispondi_stream(context, on_wait=on_wait, **sampling))
+                    
+                    # Aggiungi risposta assistant
+                    assistant_message = {
+                        "role": "assistant",
+                        "content": response,
+                        "timestamp": pd.Timestamp.now().strftime("%H:%M")
+                    }
+                    st.session_state.messages.append(assistant_message)
+                    
+                except Exception as e:
+                    error_message = {
+                        "role": "assistant",
+                        "content": f"❌ Errore durante l'elaborazione: {str(e)}",
+                        "timestamp": pd.Timestamp.now().strftime("%H:%M")
+                    }
+                    st.session_state.messages.append(error_message)
                 
                 # Pulisci input e ricarica
                 st.rerun()
@@ -0,0 +1,106 @@
+# core/async_worker.py
+import asyncio
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import AsyncIterator, Awaitable, Iterator, Optional
+
+class AsyncWorker:
+    """Thread di background che possiede un event loop persistente.
+
+    Tutte le operazioni asincrone del processo (es. @deepsearch di più utenti)
+    girano sullo stesso loop e condividono i pool HTTP. Dal codice sincrono si
+    inviano coroutine con submit() e si ottiene un Future."""
+
+    def __init__(self, name="arcadia-async"):
+        self._ready = threading.Event()
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def _run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self._ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+    def submit(self, coro: Awaitable) -> Future:
+        """Esegue la coroutine sul loop del worker; il Future si può interrogare o attendere"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None):
+        """Esegue la coroutine e ne attende il risultato"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            future.cancel()
+            raise
+
+    def iterate(self, agen: AsyncIterator, timeout: Optional[float] = None,
+                deadline: Optional[float] = None) -> Iterator:
+        """Consuma un generatore asincrono dal codice sincrono, un elemento alla volta.
+
+        Solleva TimeoutError se un elemento non arriva entro timeout secondi o se
+        si supera deadline (istante di time.monotonic())."""
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put(item)
+            except Exception as e:
+                items.put(e)
+            finally:
+                items.put(done)
+
+        future = self.submit(pump())
+        try:
+            while True:
+                wait = timeout
+                if deadline is not None:
+                    remaining = max(deadline - time.monotonic(), 0.0)
+                    wait = remaining if wait is None else min(wait, remaining)
+                try:
+                    item = items.get(timeout=wait)
+                except queue.Empty:
+                    raise TimeoutError(f"Nessun risultato entro {wait:.0f} secondi") from None
+                if item is done:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Il consumatore ha smesso di leggere: ferma anche il generatore
+            future.cancel()
+
+    def shutdown(self):
+        """Chiude le sessioni HTTP e ferma il loop"""
+        if self.loop is None or self.loop.is_closed():
+            return
+        from .deep_research import close_session
+        try:
+            self.run(close_session(), timeout=5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+_worker = None
+_worker_lock = threading.Lock()
+
+def get_worker() -> AsyncWorker:
+    """Worker asincrono del processo, creato al primo utilizzo"""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = AsyncWorker()
+            atexit.register(_worker.shutdown)
+        return _worker
@@ -0,0 +1,266 @@
+# core/batch_engine.py
+import codecs
+import time
+
+import numpy as np
+import llama_cpp
+from llama_cpp import _internals as internals
+
+# --- CONFIG ---
+N_PARALLEL = 4    # Conversazioni decodificate insieme
+N_BATCH = 512     # Token massimi per llama_decode, se la calibrazione del modello non dice altro
+PREFIX_SEQ = 0    # Sequenza riservata al prompt di sistema, copiata nelle altre
+
+class _Slot:
+    """seq_id della cache KV; tra un turno e l'altro conserva i token già valutati"""
+
+    def __init__(self, seq_id):
+        self.seq_id = seq_id
+        self.owner = None      # Conversazione a cui appartiene la cache (es. sessione)
+        self.tokens = []       # Token presenti nella cache KV della sequenza
+        self.busy = False
+        self.last_used = 0.0
+
+class _Sequence:
+    def __init__(self, key, slot, tokens, max_tokens, temperature, top_k, top_p):
+        self.key = key
+        self.slot = slot
+        self.seq_id = slot.seq_id
+        self.pending = tokens      # Token del prompt ancora da valutare
+        self.n_past = 0
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.n_generated = 0
+        self.next_token = None     # Ultimo token campionato, da valutare al prossimo passo
+        self.logits_index = None   # Posizione nel batch dei logit da campionare
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.started = False
+
+class BatchEngine:
+    """Decodifica continua di più conversazioni in un unico batch llama.cpp.
+
+    Ogni conversazione attiva ha un proprio seq_id nella cache KV. A ogni passo il
+    batch contiene un token per ogni sequenza in generazione più, nello spazio che
+    resta, un pezzo dei prompt ancora da valutare: le sequenze entrano e escono dal
+    batch senza fermare le altre. I pesi sono quelli del Llama di LocalLLM, il
+    contesto (e quindi la cache KV) è separato.
+
+    A fine risposta la sequenza resta nella cache: al turno successivo della stessa
+    conversazione si riparte dal prefisso comune più lungo (prompt di sistema,
+    riassunto, storico) e si valuta solo il testo nuovo, come LocalLLM._prepare."""
+
+    def __init__(self, llm, n_parallel=N_PARALLEL, n_ctx_per_seq=None, n_batch=None, seed=None):
+        self.llm = llm
+        self.n_parallel = n_parallel
+        self.n_ctx_per_seq = n_ctx_per_seq or llm.n_ctx
+        # n_batch calibrato per il modello (python -m core.hw_tuning), come il contesto di LocalLLM
+        self.n_batch = n_batch or llm.settings.get("n_batch") or N_BATCH
+        self.n_vocab = llm.model.n_vocab()
+        self.token_eos = llm.model.token_eos()
+        vocab = getattr(llm.model._model, "vocab", None)
+        if vocab is not None and hasattr(llama_cpp, "llama_vocab_is_eog"):
+            # Fine generazione secondo il vocabolario: EOS ma anche <|eot_id|>, <|im_end|>, <|end|>...
+            self._is_eog = lambda token: llama_cpp.llama_vocab_is_eog(vocab, token)
+        else:
+            self._is_eog = lambda token: token == self.token_eos
+        self._rng = np.random.default_rng(seed)
+
+        base = llm.model.context_params
+        params = llama_cpp.llama_context_default_params()
+        # Buffer unico: le copie del prompt di sistema condividono le celle della sequenza
+        # PREFIX_SEQ, basta una finestra per conversazione più lo spazio per rivalutare il prefisso
+        params.n_ctx = self.n_ctx_per_seq * n_parallel + max(len(llm.system_tokens), self.n_batch)
+        params.n_batch = self.n_batch
+        params.n_ubatch = self.n_batch
+        params.n_seq_max = n_parallel + 1
+        params.n_threads = base.n_threads
+        params.n_threads_batch = base.n_threads_batch
+        if hasattr(params, "kv_unified"):
+            # Con buffer KV separati per sequenza llama.cpp copia solo sequenze intere
+            # (seq_cp con intervallo termina il processo): serve un unico buffer condiviso
+            params.kv_unified = True
+        self._ctx = internals.LlamaContext(model=llm.model._model, params=params, verbose=False)
+        self._batch = internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=n_parallel + 1, verbose=False)
+
+        self._prefix = []
+        self._slots = [_Slot(seq_id) for seq_id in range(1, n_parallel + 1)]
+        self._active = {}  # chiave -> _Sequence
+
+    # --- Gestione sequenze ---
+
+    def has_free_slot(self):
+        return any(not slot.busy for slot in self._slots)
+
+    def idle(self):
+        return not self._active
+
+    def add(self, key, prompt, owner=None, max_tokens=512, temperature=0.7, top_k=40, top_p=0.95):
+        """Aggiunge una conversazione al batch; verrà servita dal prossimo step().
+
+        owner identifica la conversazione: le richieste con lo stesso owner riusano
+        la cache KV lasciata dalla precedente."""
+        tokens = self.llm.prompt_tokens(prompt)
+        max_tokens = min(max_tokens, self.n_ctx_per_seq - len(tokens))
+        if max_tokens <= 0:
+            raise ValueError("Il prompt supera la finestra di contesto")
+        slot = self._claim(owner)
+        seq = _Sequence(key, slot, tokens, max_tokens, temperature, top_k, top_p)
+        self._reuse_prefix(seq)
+        self._active[key] = seq
+
+    def remove(self, key, keep=False):
+        """Toglie una conversazione dal batch; con keep=False ne libera anche la cache KV"""
+        seq = self._active.pop(key, None)
+        if seq is None:
+            return
+        slot = seq.slot
+        slot.busy = False
+        slot.last_used = time.monotonic()
+        if not keep:
+            self._ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+            slot.tokens = []
+            slot.owner = None
+
+    def _claim(self, owner):
+        """Slot libero per la conversazione: il suo, se c'è, poi uno vuoto, poi il meno recente"""
+        free = [slot for slot in self._slots if not slot.busy]
+        if not free:
+            raise RuntimeError("Nessuno slot libero nel batch")
+        slot = next((slot for slot in free if owner is not None and slot.owner == owner), None)
+        if slot is None:
+            slot = min(free, key=lambda slot: (bool(slot.tokens), slot.last_used))
+            slot.owner = owner
+        slot.busy = True
+        return slot
+
+    def _reuse_prefix(self, seq):
+        """Tiene nella cache della sequenza il prefisso comune con il nuovo prompt e scarta il resto"""
+        slot = seq.slot
+        # Lascia almeno un token da valutare, servono i logit per campionare
+        shared = min(llama_cpp.Llama.longest_token_prefix(slot.tokens, seq.pending), len(seq.pending) - 1)
+        if shared < len(self.llm.system_tokens):
+            # Dal prompt di sistema in poi conviene la copia della sequenza condivisa
+            self._ctx.kv_cache_seq_rm(slot.seq_id, -1, -1)
+            slot.tokens = []
+            self._share_prefix(seq)
+            return
+        self._ctx.kv_cache_seq_rm(slot.seq_id, shared, -1)
+        del slot.tokens[shared:]
+        seq.pending = seq.pending[shared:]
+        seq.n_past = shared
+
+    def _share_prefix(self, seq):
+        """Copia nella sequenza la cache KV del prompt di sistema"""
+        system_tokens = self.llm.system_tokens
+        if not system_tokens or seq.pending[:len(system_tokens)] != system_tokens:
+            return
+        if self._prefix != system_tokens:
+            self._ctx.kv_cache_seq_rm(PREFIX_SEQ, -1, -1)
+            for i in range(0, len(system_tokens), self.n_batch):
+                chunk = system_tokens[i:i + self.n_batch]
+                self._batch.reset()
+                self._batch.add_sequence(chunk, PREFIX_SEQ, False)
+                for j in range(len(chunk)):
+                    self._batch.batch.pos[j] = i + j
+                self._ctx.decode(self._batch)
+            self._prefix = list(system_tokens)
+        # Lascia almeno un token da valutare, servono i logit per campionare
+        n_shared = min(len(system_tokens), len(seq.pending) - 1)
+        self._ctx.kv_cache_seq_cp(PREFIX_SEQ, seq.seq_id, 0, n_shared)
+        seq.slot.tokens = list(seq.pending[:n_shared])
+        seq.pending = seq.pending[n_shared:]
+        seq.n_past = n_shared
+
+    # --- Decodifica ---
+
+    def step(self):
+        """Esegue un llama_decode per tutte le sequenze attive.
+
+        Restituisce una lista di (chiave, delta, finito)."""
+        if not self._active:
+            return []
+        batch = self._batch.batch
+        batch.n_tokens = 0
+        budget = self.n_batch
+
+        def push(seq, token, want_logits):
+            i = batch.n_tokens
+            batch.token[i] = token
+            batch.pos[i] = seq.n_past
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq.seq_id
+            batch.logits[i] = want_logits
+            batch.n_tokens += 1
+            seq.n_past += 1
+            seq.slot.tokens.append(token)
+            if want_logits:
+                seq.logits_index = i
+
+        # Prima un token per ogni sequenza già in generazione: la loro latenza non dipende dai prompt nuovi
+        for seq in self._active.values():
+            seq.logits_index = None
+            if seq.next_token is not None:
+                push(seq, seq.next_token, True)
+                seq.next_token = None
+                budget -= 1
+        # Poi, nello spazio rimasto, pezzi dei prompt da valutare
+        for seq in self._active.values():
+            if budget <= 0:
+                break
+            if seq.pending and seq.logits_index is None:
+                chunk, seq.pending = seq.pending[:budget], seq.pending[budget:]
+                for j, token in enumerate(chunk):
+                    push(seq, token, not seq.pending and j == len(chunk) - 1)
+                budget -= len(chunk)
+
+        if batch.n_tokens == 0:
+            return []
+        self._ctx.decode(self._batch)
+
+        events = []
+        for key, seq in list(self._active.items()):
+            if seq.logits_index is None:
+                continue
+            logits = np.ctypeslib.as_array(self._ctx.get_logits_ith(seq.logits_index), shape=(self.n_vocab,))
+            token = self._sample(logits, seq)
+            seq.n_generated += 1
+            eog = self._is_eog(token)
+            finished = eog or seq.n_generated >= seq.max_tokens or seq.n_past >= self.n_ctx_per_seq
+            delta = ""
+            if not eog:
+                delta = seq.decoder.decode(self.llm.model.detokenize([token]))
+            if finished:
+                delta += seq.decoder.decode(b"", final=True)
+                # La cache resta alla conversazione per il prossimo turno
+                self.remove(key, keep=True)
+            else:
+                seq.next_token = token
+            if not seq.started:
+                # Come LocalLLM.generate_stream: niente spazi iniziali
+                delta = delta.lstrip()
+                seq.started = bool(delta)
+            events.append((key, delta, finished))
+        return events
+
+    def _sample(self, logits, seq):
+        if seq.temperature <= 0:
+            return int(np.argmax(logits))
+        k = min(seq.top_k, logits.shape[0]) if seq.top_k > 0 else logits.shape[0]
+        candidates = np.argpartition(logits, -k)[-k:]
+        scores = logits[candidates].astype(np.float64) / seq.temperature
+        order = np.argsort(-scores)
+        candidates, scores = candidates[order], scores[order]
+        probs = np.exp(scores - scores[0])
+        probs /= probs.sum()
+        if seq.top_p < 1.0:
+            keep = int(np.searchsorted(np.cumsum(probs), seq.top_p)) + 1
+            candidates, probs = candidates[:keep], probs[:keep] / probs[:keep].sum()
+        return int(self._rng.choice(candidates, p=probs))
+
+    def close(self):
+        for key in list(self._active):
+            self.remove(key)
+        self._batch.close()
+        self._ctx.close()
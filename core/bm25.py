@@ -0,0 +1,24 @@
+# core/bm25.py
+import re
+from typing import List
+
+import numpy as np
+
+# --- CONFIG ---
+K1 = 1.5
+B = 0.75
+
+# Parole: lettere e cifre (anche accentate); "_" separa le parole come la punteggiatura
+WORD_RE = re.compile(r"[^\W_]+")
+
+def tokenize(text: str) -> List[str]:
+    """Termini del testo in minuscolo, lo stesso tokenizer per ricerca, indice locale e memoria"""
+    return WORD_RE.findall(text.lower())
+
+def idf(n_docs, df):
+    """Inverse document frequency BM25 (positiva se df <= n_docs); accetta numeri o array NumPy"""
+    return np.log1p((n_docs - df + 0.5) / (df + 0.5))
+
+def weight(tf, idf_value, length, avgdl, k1=K1, b=B):
+    """Contributo BM25 di un termine al punteggio di un documento; accetta numeri o array NumPy"""
+    return idf_value * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avgdl))
@@ -3,18 +3,36 @@ import os
 import json
 import zipfile
 import base64
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Iterator, Callable, Optional
 import requests
 from io import BytesIO
 
 # --- IMPORT LOCALE ---
-from .local_llm import LocalLLM  # Il nostro runner GGUF
+from .model_registry import MODEL_REGISTRY  # Modelli GGUF condivisi tra le sessioni
+from .scheduler import PRIORITY_CHAT, PRIORITY_RESEARCH, PRIORITY_BACKGROUND, QueueFullError
+from .deep_research import DeepResearchCore  # Ricerca sul web in background (event loop condiviso)
+from .search_index import get_index  # Indice locale per @cerca
+from .memory import get_memory  # Fatti a lungo termine sull'utente
 
 # --- CONFIGURAZIONI ---
 MODELS_DIR = Path("models")
 DEFAULT_MODEL = MODELS_DIR / "phi-4-mini-q4_k_m.gguf"
 SAC_DIR = Path("sac")  # Strumenti Avanzati di CES
+MAX_REPLY_TOKENS = 512  # Spazio riservato alla risposta nella finestra di contesto
+DEFAULT_TEMPERATURE = 0.7
+RESEARCH_TIMEOUT = 120  # Secondi massimi per un @deepsearch, riassunto compreso
+PROMPT_MARGIN = 32  # Tolleranza: i pezzi tokenizzati separatamente possono differire di qualche token
+MAX_HISTORY = 200  # Messaggi conservati in memoria; nel prompt entrano quelli che stanno nel budget
+HISTORY_TOKENS = 1536  # Cronologia riportata alla lettera; oltre, i turni più vecchi finiscono nel riassunto
+SUMMARY_MAX_TOKENS = 256
+SUMMARY_IDLE_DELAY = 3.0  # Secondi di inattività dell'utente prima di aggiornare il riassunto
+MEMORY_TOKENS = 256  # Fatti ricordati riportati nel prompt, solo quelli pertinenti al messaggio
 TEMP_DIR = Path("temp")
 TEMP_DIR.mkdir(exist_ok=True)
 
@@ -36,12 +54,101 @@ RISPOSTE_PREDEFINITE = {
 # --- CLASSI ---
 
 class ArcadiaAICore:
-    def __init__(self, model_path: str = DEFAULT_MODEL):
+    def __init__(self, model_path: str = DEFAULT_MODEL, registry=MODEL_REGISTRY, memory=None,
+                 user_id: Optional[str] = None):
+        """user_id identifica l'utente nella memoria e nell'indice di @cerca; di default ogni
+        sessione è un utente a sé"""
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Modello non trovato: {model_path}")
-        self.llm = LocalLLM(model_path=str(model_path))
+        # Il modello è condiviso a livello di processo; la conversazione resta per sessione
+        self._registry = registry
+        self._model_handle = registry.acquire(model_path)
+        self.model_path = str(model_path)
+        self.llm = self._model_handle.llm
+        self.scheduler = self._model_handle.scheduler
+        # Cambio modello a caldo: "idle", "loading", "ready" oppure "error: ..."
+        self.swap_status = "idle"
+        self._swap_lock = threading.Lock()
+        self._swap_seq = 0
+        self.session_id = uuid.uuid4().hex
+        self.user_id = user_id or self.session_id
         self.conversation_history = []
-        self.max_context = 30  # Ultimi 30 messaggi
+        # Riassunto progressivo dei turni usciti dalla cronologia riportata alla lettera
+        self.summary = ""
+        self._summarized = 0  # Messaggi (contati dall'inizio della chat) già nel riassunto
+        self._trimmed = 0     # Messaggi (contati dall'inizio della chat) tolti da conversation_history
+        self._history_start = 0  # Primo messaggio (contato dall'inizio della chat) riportato nel prompt
+        # Timer e job del riassunto sono toccati dal thread di Streamlit e da quello del timer
+        self._summary_lock = threading.RLock()
+        self._summary_timer = None
+        self._summary_job = None
+        self._summary_epoch = 0  # Cresce a ogni annullamento: i riassunti avviati prima si fermano
+        # Precalcola lo stato KV del prompt di sistema: ogni turno valuta solo il suffisso
+        self.llm.set_system_prompt(self._get_system_prompt())
+        # Fatti ricordati per utente: quelli di una persona non finiscono nei prompt di altre
+        self.memory = memory if memory is not None else get_memory(self.user_id)
+        # Conversazioni, documenti e pagine lette finiscono nell'indice locale di @cerca
+        self.search_index = get_index()
+        # Riassunti delle ricerche con il modello della sessione, passaggi misurati col suo tokenizer
+        self.deep_research = DeepResearchCore(summarizer=self.analizza_stream,
+                                              count_tokens=lambda text: self.llm.count_tokens(text),
+                                              index=self.search_index,
+                                              total_deadline=RESEARCH_TIMEOUT,
+                                              owner=self.user_id)
+        self._system_prompt_tokens = self.llm.count_tokens(self._get_system_prompt()) + 1  # + BOS
+
+    def close(self):
+        """Rilascia il modello condiviso (verrà scaricato quando nessuna sessione lo usa più)"""
+        self._model_handle.release()
+
+    def switch_model(self, model_path) -> bool:
+        """Carica un altro modello in background e lo mette in uso appena è pronto.
+
+        Fino ad allora le risposte continuano con il modello attuale; l'avanzamento
+        si legge in swap_status. Restituisce False se il modello è già in uso (un eventuale
+        caricamento in corso di un altro modello viene comunque abbandonato)."""
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(f"Modello non trovato: {model_path}")
+        with self._swap_lock:
+            # Il nuovo numero rende obsoleto qualunque caricamento ancora in corso
+            self._swap_seq += 1
+            seq = self._swap_seq
+            if os.path.abspath(model_path) == os.path.abspath(self.model_path):
+                if self.swap_status == "loading":
+                    self.swap_status = "idle"
+                return False
+            self.swap_status = "loading"
+        threading.Thread(target=self._load_and_swap, args=(str(model_path), seq),
+                         name="model-swap", daemon=True).start()
+        return True
+
+    def _load_and_swap(self, model_path, seq):
+        try:
+            handle = self._registry.acquire(model_path)
+            handle.llm.set_system_prompt(self._get_system_prompt())
+            system_prompt_tokens = handle.llm.count_tokens(self._get_system_prompt()) + 1
+        except Exception as e:
+            with self._swap_lock:
+                if seq == self._swap_seq:
+                    self.swap_status = f"error: {e}"
+            return
+        with self._swap_lock:
+            if seq != self._swap_seq:
+                # Nel frattempo è stato chiesto un altro modello
+                handle.release()
+                return
+            self._cancel_summary()
+            old_handle = self._model_handle
+            self._model_handle = handle
+            self.model_path = model_path
+            self.llm = handle.llm
+            self.scheduler = handle.scheduler
+            self._system_prompt_tokens = system_prompt_tokens
+            # I conteggi dei token dipendono dal tokenizer del modello
+            for msg in self.conversation_history:
+                msg.pop("tokens", None)
+            self.swap_status = "ready"
+        old_handle.release()
 
     def _get_system_prompt(self) -> str:
         """Prompt identitario locale"""
@@ -52,7 +159,7 @@ Funzionalità:
 - Comandi Rapidi (@cerca, @esporta, @aiuto...)
 - Generazione testo/immagini (@immagine)
 - Analisi documenti (PDF/testo)
-- Memoria contestuale (ultimi 30 messaggi)
+- Memoria contestuale (conversazione recente e fatti ricordati sull'utente)
 - Creazione file ZIP (@crea zip)
 - Accesso a repository software (@app)
 
@@ -64,36 +171,208 @@ Linee guida:
 5. I SAC sono 'Strumenti Avanzati di CES', open source e modificabili
 """
 
-    def _build_prompt(self, message: str) -> str:
-        """Costruisce il prompt con contesto"""
-        prompt = self._get_system_prompt()
-        # Aggiungi cronologia recente
-        recent = self.conversation_history[-(self.max_context - 1):]
-        for msg in recent:
-            role = "Utente" if msg["role"] == "user" else "Assistant"
-            prompt += f"\n{role}: {msg['content']}"
-        prompt += f"\nUtente: {message}\nAssistant: "
-        return prompt
+    @staticmethod
+    def _history_line(msg: Dict) -> str:
+        role = "Utente" if msg["role"] == "user" else "Assistant"
+        return f"\n{role}: {msg['content']}"
+
+    def _history_tokens(self, msg: Dict) -> int:
+        """Token di un messaggio della cronologia (calcolati una volta sola)"""
+        if "tokens" not in msg:
+            msg["tokens"] = self.llm.count_tokens(self._history_line(msg))
+        return msg["tokens"]
+
+    def _build_prompt(self, message: str, context_text: str = "", max_tokens: int = MAX_REPLY_TOKENS) -> str:
+        """Costruisce il prompt con contesto, senza superare la finestra del modello.
+
+        Hanno la precedenza prompt di sistema, messaggio corrente e spazio per la risposta;
+        gli allegati vengono accorciati e della cronologia entrano i messaggi più recenti
+        che stanno nei token rimasti."""
+        budget = self.llm.n_ctx - self._system_prompt_tokens - max_tokens - PROMPT_MARGIN
+        summary_block = f"\nRiassunto della conversazione precedente: {self.summary}" if self.summary else ""
+        budget -= self.llm.count_tokens(summary_block)
+        closing = "\nAssistant: "
+        head = f"\nUtente: {message}"
+        budget -= self.llm.count_tokens(head + closing)
+        if budget < 0:
+            # Messaggio più lungo della finestra: tieni l'inizio
+            message = self.llm.truncate(message, self.llm.count_tokens(message) + budget)
+            head = f"\nUtente: {message}"
+            budget = 0
+        # Fatti ricordati pertinenti al messaggio, subito prima di esso: la parte iniziale
+        # del prompt (sistema, riassunto, cronologia) resta uguale e la cache KV si riusa
+        facts = self.memory.relevant_facts(message, min(MEMORY_TOKENS, max(budget, 0) // 4), self.llm.count_tokens)
+        if facts:
+            memory_block = "\nCose che ricordi dell'utente:\n" + "\n".join(f"- {fact}" for fact in facts)
+            head = memory_block + head
+            budget -= self.llm.count_tokens(memory_block)
+        if context_text:
+            # Gli allegati non possono occupare più di metà dello spazio che serve alla cronologia
+            history_need = sum(self._history_tokens(msg) for msg in self._unsummarized())
+            context_head = "\n\nContesto aggiuntivo:\n"
+            room = budget - min(history_need, budget // 2) - self.llm.count_tokens(context_head)
+            if room > 0:
+                context_text = self.llm.truncate(context_text, room)
+                head += context_head + context_text
+                budget -= self.llm.count_tokens(context_head + context_text)
+        # Cronologia non ancora riassunta, dal primo messaggio ancora riportato. Quando non sta più
+        # nel budget si tolgono in blocco i più vecchi fino a metà budget: l'inizio del prompt resta
+        # uguale per diversi turni e la cache KV del prefisso continua a servire
+        budget = min(budget, HISTORY_TOKENS)
+        start = max(self._history_start, self._summarized, self._trimmed)
+        history = self.conversation_history[start - self._trimmed:]
+        total = sum(self._history_tokens(msg) for msg in history)
+        if total > budget:
+            while history and total > budget // 2:
+                total -= self._history_tokens(history.pop(0))
+                start += 1
+            self._history_start = start
+        lines = [self._history_line(msg) for msg in history]
+        return self._get_system_prompt() + summary_block + "".join(lines) + head + closing
 
     def _add_to_history(self, role: str, content: str):
         self.conversation_history.append({"role": role, "content": content})
+        position = self._trimmed + len(self.conversation_history)
+        title = f"{'Tu' if role == 'user' else 'ArcadiaAI'} · {datetime.now():%d/%m/%Y %H:%M}"
+        # La posizione rende la chiave nuova: niente controllo dei duplicati
+        self._indicizza(f"chat:{self.session_id}:{position}", content, "chat", title, unique=True)
         # Limita dimensione cronologia
-        if len(self.conversation_history) > self.max_context:
-            self.conversation_history = self.conversation_history[-self.max_context:]
+        if len(self.conversation_history) > MAX_HISTORY:
+            self._trimmed += len(self.conversation_history) - MAX_HISTORY
+            self.conversation_history = self.conversation_history[-MAX_HISTORY:]
+
+    # --- Riassunto progressivo ---
+
+    def _unsummarized(self) -> List[Dict]:
+        return self.conversation_history[max(self._summarized - self._trimmed, 0):]
 
-    def rispondi(self, message: str, attachments: List[Dict] = None) -> str:
+    def _cancel_summary(self):
+        """L'utente è tornato attivo: il riassunto aspetta il prossimo momento di pausa"""
+        with self._summary_lock:
+            self._summary_epoch += 1
+            if self._summary_timer is not None:
+                self._summary_timer.cancel()
+                self._summary_timer = None
+            if self._summary_job is not None:
+                self._summary_job.cancel()
+                self._summary_job = None
+
+    def _schedule_summary(self):
+        """Programma l'aggiornamento del riassunto se la cronologia alla lettera è troppo lunga"""
+        pending = self._unsummarized()
+        if sum(self._history_tokens(msg) for msg in pending) <= HISTORY_TOKENS:
+            return
+        with self._summary_lock:
+            self._cancel_summary()
+            self._summary_timer = threading.Timer(SUMMARY_IDLE_DELAY, self._refresh_summary,
+                                                  args=(self._summary_epoch,))
+            self._summary_timer.daemon = True
+            self._summary_timer.start()
+
+    def _summary_prompt(self, previous: str, messages: List[Dict]) -> str:
+        return (
+            "Aggiorna il riassunto di una conversazione tra un utente e l'assistente ArcadiaAI.\n"
+            f"Riassunto attuale: {previous or '(vuoto)'}\n"
+            "Nuovi messaggi:" + "".join(self._history_line(msg) for msg in messages) + "\n"
+            "Scrivi il riassunto aggiornato in italiano, in poche frasi, conservando fatti, nomi, "
+            "preferenze e richieste dell'utente.\nRiassunto: "
+        )
+
+    def _fold_batch(self, previous: str, messages: List[Dict]) -> List[Dict]:
+        """I primi messaggi che stanno nella finestra di contesto insieme al riassunto e alla risposta"""
+        budget = (self.llm.n_ctx - SUMMARY_MAX_TOKENS - PROMPT_MARGIN - 1  # BOS
+                  - self.llm.count_tokens(self._summary_prompt(previous, [])))
+        batch = []
+        for msg in messages:
+            n = self._history_tokens(msg)
+            if n > budget:
+                if not batch:
+                    # Un messaggio da solo non entra: se ne riassume l'inizio
+                    room = budget - self.llm.count_tokens(self._history_line({**msg, "content": ""}))
+                    if room > 0:
+                        batch.append({"role": msg["role"], "content": self.llm.truncate(msg["content"], room)})
+                break
+            batch.append(msg)
+            budget -= n
+        return batch
+
+    def _refresh_summary(self, epoch: int):
+        """Riassume i turni più vecchi finché la cronologia alla lettera torna a metà di HISTORY_TOKENS.
+
+        Ogni passo riassume solo i messaggi che stanno nella finestra di contesto; si
+        ferma appena l'utente torna attivo (epoch superata)."""
+        while True:
+            with self._summary_lock:
+                if epoch != self._summary_epoch:
+                    return
+                self._summary_timer = None
+                pending = self._unsummarized()
+                keep = 0
+                kept_tokens = 0
+                for msg in reversed(pending):
+                    kept_tokens += self._history_tokens(msg)
+                    if kept_tokens > HISTORY_TOKENS // 2:
+                        break
+                    keep += 1
+                start = self._summarized
+                previous = self.summary
+            to_fold = self._fold_batch(previous, pending[:len(pending) - keep])
+            if not to_fold:
+                return
+            try:
+                job = self.scheduler.submit(
+                    self._summary_prompt(previous, to_fold), session_id=self.session_id,
+                    priority=PRIORITY_BACKGROUND, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.2)
+            except Exception:
+                return  # Riproveremo dopo il prossimo turno
+            with self._summary_lock:
+                if epoch != self._summary_epoch:
+                    job.cancel()  # L'utente ha scritto mentre il job veniva accodato
+                    return
+                self._summary_job = job
+            try:
+                summary = job.result()
+            except Exception:
+                return
+            finally:
+                with self._summary_lock:
+                    if self._summary_job is job:
+                        self._summary_job = None
+            if job.state != "done":
+                return  # Annullato perché l'utente ha scritto di nuovo
+            with self._summary_lock:
+                if not summary or self._summarized != start:
+                    return
+                self.summary = summary
+                self._summarized = start + len(to_fold)
+
+    def rispondi(self, message: str, attachments: List[Dict] = None,
+                 temperature: float = DEFAULT_TEMPERATURE, max_tokens: int = MAX_REPLY_TOKENS) -> str:
         """Gestisce messaggio + allegati"""
+        return "".join(self.rispondi_stream(message, attachments, temperature=temperature,
+                                            max_tokens=max_tokens)).strip()
+
+    def rispondi_stream(self, message: str, attachments: List[Dict] = None,
+                        on_wait: Optional[Callable[[int, float], None]] = None,
+                        temperature: float = DEFAULT_TEMPERATURE,
+                        max_tokens: int = MAX_REPLY_TOKENS) -> Iterator[str]:
+        """Come rispondi(), ma restituisce la risposta a pezzi man mano che il modello la genera.
+        La cronologia viene aggiornata solo a stream concluso. Mentre la richiesta è in coda
+        on_wait(posizione, attesa_stimata) viene chiamato periodicamente."""
         message = message.strip()
         if not message:
-            return "Non hai scritto nulla."
+            yield "Non hai scritto nulla."
+            return
         # 1. Comandi rapidi
         if message.startswith("@"):
-            return self._gestisci_comando(message, attachments)
+            yield self._gestisci_comando(message, attachments)
+            return
         # 2. Risposte predefinite
         if message.lower() in RISPOSTE_PREDEFINITE:
             reply = RISPOSTE_PREDEFINITE[message.lower()]
             self._add_to_history("assistant", reply)
-            return reply
+            yield reply
+            return
         # 3. Estrai testo da allegati
         context_text = ""
         if attachments:
@@ -104,24 +383,42 @@ Linee guida:
                     name = att.get('name', 'file')
                     text = self._estrai_testo(data, mime, name)
                     if text:
+                        self.indicizza_documento(name, text)
                         context_text += f"\n[Testo da {name}]: {text[:1000]}"
                 except Exception as e:
                     context_text += f"\n[Errore lettura {att.get('name')}]"
-        # 4. Prompt completo
-        full_message = message
-        if context_text:
-            full_message += f"\n\nContesto aggiuntivo:\n{context_text}"
+        # 4. Prompt completo, entro la finestra di contesto
+        self._cancel_summary()
+        prompt = self._build_prompt(message, context_text, max_tokens=max_tokens)
         # 5. Genera risposta con LLM locale
-        prompt = self._build_prompt(full_message)
+        parts = []
         try:
-            reply = self.llm.generate(prompt)
-            self._add_to_history("user", message)
-            self._add_to_history("assistant", reply)
-            return reply
+            job = self.scheduler.submit(prompt, session_id=self.session_id, priority=PRIORITY_CHAT,
+                                        max_tokens=max_tokens, temperature=temperature)
+            for delta in job.stream(on_wait=on_wait):
+                parts.append(delta)
+                yield delta
+        except QueueFullError:
+            yield "⏳ Il server è occupato da molte richieste. Riprova tra qualche istante."
+            return
         except Exception as e:
             error_msg = f"❌ Errore modello locale: {str(e)}"
             self._add_to_history("assistant", error_msg)
-            return error_msg
+            yield ("\n\n" if parts else "") + error_msg
+            return
+        reply = "".join(parts).strip()
+        self._add_to_history("user", message)
+        self._add_to_history("assistant", reply)
+        self._schedule_summary()
+
+    def analizza_stream(self, prompt: str, timeout: Optional[float] = None) -> Iterator[str]:
+        """Genera un'analisi (es. il riassunto di una ricerca) con priorità di ricerca, un pezzo alla volta.
+
+        Non entra nella cronologia; chiudere l'iteratore annulla la generazione. Oltre
+        timeout secondi, attesa in coda compresa, la generazione viene annullata con TimeoutError."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        job = self.scheduler.submit(prompt, session_id=self.session_id, priority=PRIORITY_RESEARCH)
+        return job.stream(deadline=deadline)
 
     def _gestisci_comando(self, command: str, attachments=None) -> str:
         """Gestisce tutti i comandi @..."""
@@ -132,21 +429,12 @@ Linee guida:
             query = command[len("@deepsearch"):].strip()
             if not query:
                 return "❌ Specifica una query. Esempio: @deepsearch impatto climatico dell'IA"
-            import asyncio
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(deep_research(query))
-            if "error" in result:
-                return f"❌ Errore ricerca: {result['error']}"
-            if not result["results"]:
-                return "❌ Nessun risultato trovato."
-            analysis_prompt = (
-                f"Analizza questi risultati su '{query}':\n"
-                + "\n".join([f"- {r['title']} ({r['url']})" for r in result["results"]])
-                + "\nFai un riassunto in 3 frasi, in italiano."
-            )
-            reply = self.llm.generate(analysis_prompt)
-            return f"🔍 **Deep Search Completo**: _{query}_\n📊 **Fonti analizzate**: {result['count']}\n\n{reply}"
+            try:
+                return self.deep_research.research(query)
+            except TimeoutError:
+                return "❌ La ricerca ha impiegato troppo tempo. Riprova."
+            except Exception as e:
+                return f"❌ Errore ricerca: {e}"
         elif cmd_lower.startswith("@immagine"):
             desc = command[len("@immagine"):].strip()
             return self._genera_immagine(desc)
@@ -168,7 +456,7 @@ Linee guida:
 - `@immagine [descrizione]` → genera un'immagine concettuale
 - `@crea zip` → crea un file ZIP vuoto (SAC: ZIP Service)
 - `@app` → mostra repository software disponibili
-- `@cerca [termine]` → cerca informazioni nel contesto
+- `@cerca [termine]` → cerca nelle conversazioni, nei documenti e nelle pagine salvate
 - `@codice_sorgente` → link al codice open source
 - `@aiuto` → mostra questo messaggio
 """
@@ -194,8 +482,30 @@ Linee guida:
         links = "\n".join([f"- {repo}" for repo in repos])
         return f"📦 Repository disponibili:\n{links}\nUsa il gestore del tuo sistema operativo per installare app."
 
+    def indicizza_documento(self, name: str, text: str):
+        """Rende un documento caricato cercabile con @cerca"""
+        digest = hashlib.sha1(text.encode("utf-8", errors="replace")).hexdigest()
+        self._indicizza(f"file:{name}:{digest}", text, "file", name)
+
+    def _indicizza(self, key: str, text: str, kind: str, title: str, unique: bool = False):
+        try:
+            self.search_index.add(key, text, kind, title, unique=unique, owner=self.user_id)
+        except OSError:
+            pass  # L'indice è un servizio in più: la chat continua anche se il disco non collabora
+
     def _cerca_locale(self, query: str) -> str:
-        return f"🔍 Ricerca locale: '{query}'. In futuro, integrerò un motore di ricerca offline."
+        if not query:
+            return "❌ Specifica cosa cercare. Esempio: @cerca ricetta della carbonara"
+        start = time.perf_counter()
+        results = self.search_index.search(query, k=5, owner=self.user_id)
+        elapsed = (time.perf_counter() - start) * 1000
+        if not results:
+            return f"🔍 Nessun risultato per '{query}' nelle conversazioni, nei documenti e nelle pagine salvate."
+        icons = {"chat": "💬", "file": "📄", "page": "🌐"}
+        lines = [f"🔍 **Ricerca locale**: _{query}_ ({len(results)} risultati in {elapsed:.0f} ms)\n"]
+        for i, res in enumerate(results, 1):
+            lines.append(f"{i}. {icons.get(res['kind'], '📌')} **{res['title'] or res['key']}**\n   {res['snippet']}")
+        return "\n".join(lines)
 
     def _estrai_testo(self, data: bytes, mime: str, name: str) -> str:
         """Estrae testo da PDF o file di testo"""
@@ -1,118 +1,658 @@
 import asyncio
+import codecs
+import weakref
 import aiohttp
-import requests
+import numpy as np
 from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 from urllib.parse import urlparse
 import re
-from typing import List, Dict
+import time
+from collections import Counter
+from typing import List, Dict, AsyncIterator, Callable, Iterator, Optional, Tuple
+
+from . import bm25
+from .async_worker import get_worker
+from .http_cache import HTTPCache, PAGE_TTL, SEARCH_TTL
+from .search_index import SearchIndex
 
 # --- CONFIG ---
 USER_AGENTS = [
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
 ]
+FETCH_TIMEOUT = 10        # Secondi per singola pagina
+FETCH_DEADLINE = 15       # Secondi per l'intera fase di download
+MAX_CANDIDATES = 6        # Pagine scaricate in parallelo
+MAX_PAGES = 3             # Pagine restituite
+GOOD_RELEVANCE = 0.5      # Con MAX_PAGES pagine almeno così rilevanti si smette di aspettare
+SEARCH_DEADLINE = 10      # Secondi per l'intera fase di ricerca (tutti i motori)
+SUMMARY_DEADLINE = 90     # Secondi per il riassunto del modello
+PASSAGE_WORDS = 80        # Parole per passaggio
+PASSAGE_OVERLAP = 20      # Parole in comune tra passaggi consecutivi
+MAX_PASSAGES = 8          # Passaggi candidati per il riassunto
+PASSAGE_TOKENS = 768      # Token del prompt di riassunto riservati ai passaggi
+CONNECTIONS_PER_HOST = 2
+MAX_CONNECTIONS = 50
+DNS_CACHE_TTL = 300
+MAX_ENTITIES = 20             # Entità conservate per pagina
+MAX_PAGE_BYTES = 1024 * 1024  # Byte letti al massimo per pagina
+MAX_PAGE_CHARS = 20000        # Caratteri di testo estratti per pagina
+READ_CHUNK = 64 * 1024
 SEARCH_ENGINES = {
     "duckduckgo": {
         "url": "https://html.duckduckgo.com/html/",
         "method": "POST",
-        "params": {"q": "", "kl": "it-it"}
+        "params": {"q": "", "kl": "it-it"},
+        "timeout": 8
     },
     "brave": {
         "url": "https://search.brave.com/search",
         "method": "GET",
-        "params": {"q": ""}
+        "params": {"q": ""},
+        "timeout": 8
     }
 }
 
+# Entità riconosciute, in ordine di priorità (la prima alternativa che combacia vince).
+# Ogni alternativa può iniziare solo all'inizio di una parola/numero (lookbehind), così
+# su parole lunghe senza corrispondenza non si riprova da ogni carattere: tempo lineare.
+_MONTHS = ("gennaio|febbraio|marzo|aprile|maggio|giugno|luglio|agosto|settembre|ottobre|novembre|dicembre|"
+           "january|february|march|april|may|june|july|august|september|october|november|december")
+_UNITS = (r"%|€|\$|°C|°F|kWh|kW|MW|W|GHz|MHz|Hz|TB|GB|MB|KB|kB|km|cm|mm|m|kg|mg|g|ml|l|"
+          r"anni|mesi|giorni|ore|minuti|secondi|milioni|miliardi|euro|dollari")
+ENTITY_RE = re.compile(
+    r"(?P<url>(?<![\w/])https?://[^\s<>\"'()\[\]]*[^\s<>\"'()\[\].,;:!?])"
+    r"|(?P<email>(?<![\w.+-])[\w.+-]+@[\w-]+(?:\.[\w-]+)+)"
+    r"|(?P<date>(?<![\w/.-])(?:\d{4}-\d{2}-\d{2}|\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}"
+    rf"|\d{{1,2}}\s+(?i:{_MONTHS})\s+\d{{4}})(?![\w/])"
+    r")"
+    rf"|(?P<quantity>(?<![\w.,])\d+(?:[.,]\d+)*\s?(?:{_UNITS})(?!\w))"
+    r"|(?P<name>\b[A-ZÀ-Ý][a-zà-ÿ]+(?:\s+(?:(?:di|de|da|del|della|van|von)\s+)?[A-ZÀ-Ý][a-zà-ÿ]+)+)"
+)
+
+class BM25Index:
+    """Statistiche dei termini di un insieme di documenti (frequenze e lunghezze), calcolate una volta.
+
+    I punteggi BM25 di tutti i documenti per una query si calcolano insieme con NumPy."""
+
+    def __init__(self, documents: List[Counter], k1: float = bm25.K1, b: float = bm25.B):
+        self.documents = documents
+        self.k1 = k1
+        self.b = b
+        self.lengths = np.array([sum(doc.values()) for doc in documents], dtype=np.float64)
+        self.avgdl = self.lengths.mean() if len(documents) and self.lengths.mean() > 0 else 1.0
+
+    def scores(self, query_terms: List[str]) -> np.ndarray:
+        terms = list(dict.fromkeys(query_terms))
+        n = len(self.documents)
+        if not n or not terms:
+            return np.zeros(n)
+        # Matrice documenti × termini della query
+        tf = np.array([[doc.get(t, 0) for t in terms] for doc in self.documents], dtype=np.float64)
+        idf = bm25.idf(n, np.count_nonzero(tf, axis=0))
+        return bm25.weight(tf, idf, self.lengths[:, None], self.avgdl, self.k1, self.b).sum(axis=1)
+
 class ContentAnalyzer:
-    def calculate_relevance(self, query: str, text: str, url: str) -> float:
-        score = 0
-        q_words = query.lower().split()
-        text_lower = text.lower()
-        for word in q_words:
-            if word in text_lower:
-                score += 1
-        return min(score / len(q_words), 1.0)
-
-    def extract_entities(self, text: str) -> List[str]:
-        # Estrai date, email, URL, ecc.
-        dates = re.findall(r'\b\d{1,2}[\/\-]\d{1,2}[\/\-]\d{2,4}\b', text)
-        emails = re.findall(r'\S+@\S+\.\S+', text)
-        return list(set(dates + emails))[:5]
-
-async def search_duckduckgo(query: str) -> List[Dict]:
-    async with aiohttp.ClientSession() as session:
-        engine = SEARCH_ENGINES["duckduckgo"]
-        async with session.post(engine["url"], data=engine["params"]) as response:
-            html = await response.text()
-            soup = BeautifulSoup(html, 'html.parser')
-            results = []
-            for h in soup.find_all('a', href=True):
-                href = h['href']
-                if href.startswith('https://') and not 'duckduckgo' in href:
-                    title = h.get_text(strip=True)
-                    results.append({"title": title, "url": href})
-                    if len(results) >= 3:
-                        break
-            return results
-
-async def search_brave(query: str) -> List[Dict]:
-    async with aiohttp.ClientSession() as session:
-        engine = SEARCH_ENGINES["brave"]
-        params = {**engine["params"], "q": query}
-        async with session.get(engine["url"], params=params) as response:
-            html = await response.text()
-            soup = BeautifulSoup(html, 'html.parser')
-            results = []
-            for a in soup.select('main a'):
-                href = a.get('href')
-                if href and href.startswith('http'):
-                    title = a.get_text(strip=True)
-                    results.append({"title": title, "url": href})
-                    if len(results) >= 3:
-                        break
-            return results
-
-async def deep_research(query: str) -> Dict:
-    """Esegue una ricerca approfondita usando motori etici"""
-    analyzer = ContentAnalyzer()
+    def __init__(self, k1: float = bm25.K1, b: float = bm25.B):
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return bm25.tokenize(text)
+
+    def term_frequencies(self, text: str) -> Counter:
+        """Vettore delle frequenze dei termini: il testo si tokenizza una volta sola"""
+        return Counter(self.tokenize(text))
+
+    def calculate_relevance(self, query: str, text: str, url: str, terms: Counter = None) -> float:
+        """Frazione delle parole della query presenti nel testo (0-1)"""
+        q_words = set(self.tokenize(query))
+        if not q_words:
+            return 0.0
+        terms = terms if terms is not None else self.term_frequencies(text)
+        return sum(1 for word in q_words if word in terms) / len(q_words)
+
+    def bm25(self, query: str, documents: List[Counter]) -> np.ndarray:
+        """Punteggi BM25 della query per ciascun documento (frequenze da term_frequencies)"""
+        return BM25Index(documents, self.k1, self.b).scores(self.tokenize(query))
+
+    def extract_entities(self, text: str, limit: Optional[int] = None) -> List[Dict]:
+        """Date, email, URL, quantità con unità e nomi propri, in ordine di prima comparsa.
+
+        Un solo passaggio sul testo con un'unica espressione precompilata; ogni entità
+        compare una volta, con la posizione (start, end) della prima occorrenza."""
+        entities, seen = [], set()
+        for match in ENTITY_RE.finditer(text):
+            kind = match.lastgroup
+            value = match.group()
+            if (kind, value) in seen:
+                continue
+            seen.add((kind, value))
+            entities.append({"type": kind, "text": value, "start": match.start(), "end": match.end()})
+            if limit is not None and len(entities) >= limit:
+                break
+        return entities
+
+HTTP_CACHE = HTTPCache()
+
+# --- SESSIONE HTTP CONDIVISA ---
+
+_sessions = weakref.WeakKeyDictionary()  # event loop -> ClientSession
+
+def get_session() -> aiohttp.ClientSession:
+    """Sessione aiohttp condivisa (pool di connessioni e cache DNS) per l'event loop corrente"""
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=CONNECTIONS_PER_HOST,
+                                         ttl_dns_cache=DNS_CACHE_TTL)
+        session = aiohttp.ClientSession(connector=connector, headers={"User-Agent": USER_AGENTS[0]})
+        _sessions[loop] = session
+    return session
+
+async def close_session():
+    """Chiude la sessione dell'event loop corrente (da chiamare prima di chiudere il loop)"""
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+# --- MOTORI DI RICERCA ---
+
+async def search_duckduckgo(query: str, session: aiohttp.ClientSession = None, engine: Dict = None) -> List[Dict]:
+    session = session or get_session()
+    engine = engine or SEARCH_ENGINES["duckduckgo"]
+    data = {**engine["params"], "q": query}
+    async with session.post(engine["url"], data=data) as response:
+        html = await response.text()
+        soup = BeautifulSoup(html, 'html.parser')
+        results = []
+        for h in soup.find_all('a', href=True):
+            href = h['href']
+            if href.startswith(('https://', 'http://')) and 'duckduckgo' not in urlparse(href).netloc:
+                title = h.get_text(strip=True)
+                results.append({"title": title, "url": href})
+                if len(results) >= 3:
+                    break
+        return results
+
+async def search_brave(query: str, session: aiohttp.ClientSession = None, engine: Dict = None) -> List[Dict]:
+    session = session or get_session()
+    engine = engine or SEARCH_ENGINES["brave"]
+    params = {**engine["params"], "q": query}
+    async with session.get(engine["url"], params=params) as response:
+        html = await response.text()
+        soup = BeautifulSoup(html, 'html.parser')
+        results = []
+        for a in soup.select('main a'):
+            href = a.get('href')
+            if href and href.startswith('http'):
+                title = a.get_text(strip=True)
+                results.append({"title": title, "url": href})
+                if len(results) >= 3:
+                    break
+        return results
+
+ENGINE_SEARCHERS = {
+    "duckduckgo": search_duckduckgo,
+    "brave": search_brave,
+}
+
+def _engine_parser(name: str, engine: Dict) -> Optional[Callable]:
+    """Funzione che interroga il motore: quella della configurazione ("parser"), altrimenti quella per nome.
+
+    Il parser riceve (query, session, engine) e restituisce [{"title", "url"}, ...]."""
+    return engine.get("parser") or ENGINE_SEARCHERS.get(name)
+
+async def _search_engine(name: str, query: str, session: aiohttp.ClientSession,
+                         cache: HTTPCache = HTTP_CACHE, engines: Dict = None) -> Tuple[str, List[Dict]]:
+    """Interroga un motore entro il suo timeout; in caso di errore nessun risultato"""
+    engine = (engines or SEARCH_ENGINES)[name]
+    entry = None
+    if cache is not None:
+        key = cache.key("search", name, engine["url"], query)
+        entry = await asyncio.to_thread(cache.get, key)
+        if entry is not None and cache.is_fresh(entry):
+            return name, entry["payload"]
     try:
-        # Ricerca su più motori
-        ddg_results = await search_duckduckgo(query)
-        brave_results = await search_brave(query)
-        all_results = ddg_results + brave_results
-
-        # Deduplica per dominio
-        seen_domains = set()
-        unique_results = []
-        for res in all_results:
-            domain = urlparse(res["url"]).netloc
-            if domain not in seen_domains:
-                unique_results.append(res)
-                seen_domains.add(domain)
-
-        # Scarica e analizza i primi 3 risultati
-        final_results = []
-        for res in unique_results[:3]:
+        results = await asyncio.wait_for(_engine_parser(name, engine)(query, session, engine),
+                                         timeout=engine.get("timeout", FETCH_TIMEOUT))
+    except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, ValueError):
+        # Meglio risultati vecchi che nessun risultato
+        return name, entry["payload"] if entry is not None else []
+    if results and cache is not None:
+        await asyncio.to_thread(cache.put, key, results, SEARCH_TTL)
+    return name, results
+
+async def search_engines(query: str, session: aiohttp.ClientSession = None, cache: HTTPCache = HTTP_CACHE,
+                         engines: Dict = None, deadline: float = SEARCH_DEADLINE) -> AsyncIterator[Tuple[str, List[Dict]]]:
+    """Interroga tutti i motori configurati in parallelo e restituisce (motore, risultati) man mano che rispondono.
+
+    Allo scadere di deadline i motori che non hanno ancora risposto vengono lasciati indietro."""
+    session = session or get_session()
+    engines = engines or SEARCH_ENGINES
+    tasks = [asyncio.create_task(_search_engine(name, query, session, cache, engines))
+             for name, engine in engines.items() if _engine_parser(name, engine) is not None]
+    try:
+        for next_engine in asyncio.as_completed(tasks, timeout=deadline):
             try:
-                response = requests.get(res["url"], timeout=10, headers={"User-Agent": USER_AGENTS[0]})
-                soup = BeautifulSoup(response.content, 'html.parser')
-                text = soup.get_text()[:2000]  # Primi 2000 caratteri
-                relevance = analyzer.calculate_relevance(query, text, res["url"])
-                entities = analyzer.extract_entities(text)
-                final_results.append({
-                    "title": res["title"],
-                    "url": res["url"],
-                    "text": text,
-                    "relevance": relevance,
-                    "entities": entities
-                })
-            except:
+                result = await next_engine
+            except asyncio.TimeoutError:
+                break
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def _add_unique(unique_results: List[Dict], seen_domains: set, results: List[Dict]):
+    """Aggiunge i risultati di un dominio non ancora visto"""
+    for res in results:
+        domain = urlparse(res["url"]).netloc
+        if domain not in seen_domains:
+            unique_results.append(res)
+            seen_domains.add(domain)
+
+# --- ESTRAZIONE DEL TESTO ---
+
+# Elementi il cui contenuto non è testo della pagina (codice, menu, intestazioni, moduli)
+SKIP_TAGS = {"head", "script", "style", "noscript", "template", "svg", "iframe",
+             "nav", "header", "footer", "aside", "form", "button", "select"}
+BLOCK_TAGS = {"p", "div", "section", "article", "main", "li", "tr", "br", "h1", "h2", "h3",
+              "h4", "h5", "h6", "pre", "blockquote", "dd", "dt", "td", "th", "table", "ul", "ol"}
+
+class TextExtractor(HTMLParser):
+    """Estrae il testo visibile da HTML fornito a pezzi (feed), senza costruire l'albero.
+
+    Salta script, stili e parti di contorno (nav, header, footer...) e segnala con
+    `done` quando ha raccolto max_chars caratteri, così chi legge può smettere di scaricare."""
+
+    def __init__(self, max_chars: int = MAX_PAGE_CHARS):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.done = False
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag in BLOCK_TAGS:
+            self._newline()
+
+    def handle_endtag(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(0, self._skip - 1)
+        elif tag in BLOCK_TAGS:
+            self._newline()
+
+    def _newline(self):
+        if self.parts and self.parts[-1] != "\n" and not self.done:
+            self.parts.append("\n")
+            self.length += 1
+
+    def handle_data(self, data):
+        if self._skip or self.done:
+            return
+        text = " ".join(data.split())
+        if not text:
+            return
+        if self.parts and self.parts[-1] != "\n":
+            text = " " + text
+        remaining = self.max_chars - self.length
+        if len(text) >= remaining:
+            text = text[:remaining]
+            self.done = True
+        self.parts.append(text)
+        self.length += len(text)
+
+    def text(self) -> str:
+        return "".join(self.parts).strip()
+
+def _is_text(content_type: str) -> bool:
+    return content_type.startswith("text/") or content_type == "application/xhtml+xml"
+
+async def _stream_text(response: aiohttp.ClientResponse, max_bytes: int = MAX_PAGE_BYTES,
+                       max_chars: int = MAX_PAGE_CHARS) -> str:
+    """Legge il corpo a blocchi estraendo il testo man mano.
+
+    Si ferma al primo tra: fine del corpo, max_bytes letti, max_chars caratteri estratti."""
+    if not _is_text(response.content_type):
+        raise ValueError(f"Contenuto non testuale: {response.content_type}")
+    try:
+        decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    parser = TextExtractor(max_chars)
+    read = 0
+    async for chunk in response.content.iter_chunked(READ_CHUNK):
+        chunk = chunk[:max_bytes - read]
+        read += len(chunk)
+        # Il parsing è CPU-bound: fuori dall'event loop, un blocco alla volta
+        await asyncio.to_thread(parser.feed, decoder.decode(chunk))
+        if parser.done or read >= max_bytes:
+            break
+    return parser.text()
+
+async def fetch_text(session: aiohttp.ClientSession, url: str, cache: HTTPCache = HTTP_CACHE) -> str:
+    """Testo estratto da una pagina, dalla cache quando possibile.
+
+    Una voce scaduta viene rivalidata con If-None-Match/If-Modified-Since: se il
+    server risponde 304 il testo salvato torna valido senza riscaricare né riparsare."""
+    if cache is None:
+        async with session.get(url, timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as response:
+            response.raise_for_status()
+            return await _stream_text(response)
+    key = cache.key("page", url)
+    entry = await asyncio.to_thread(cache.get, key)
+    if entry is not None and cache.is_fresh(entry):
+        return entry["payload"]
+    async with session.get(url, headers=cache.validators(entry),
+                           timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT)) as response:
+        if response.status == 304 and entry is not None:
+            await asyncio.to_thread(cache.refresh, key, entry, PAGE_TTL)
+            return entry["payload"]
+        response.raise_for_status()
+        text = await _stream_text(response)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+    await asyncio.to_thread(cache.put, key, text, PAGE_TTL, etag, last_modified)
+    return text
+
+async def fetch_page(session: aiohttp.ClientSession, res: Dict, query: str, analyzer: "ContentAnalyzer",
+                     cache: HTTPCache = HTTP_CACHE) -> Dict:
+    """Scarica e analizza una pagina; None se non raggiungibile"""
+    try:
+        text = await fetch_text(session, res["url"], cache)
+    except (aiohttp.ClientError, asyncio.TimeoutError, UnicodeError, ValueError):
+        return None
+    terms = analyzer.term_frequencies(text)
+    return {
+        "title": res["title"],
+        "url": res["url"],
+        "text": text,
+        "terms": terms,
+        "relevance": analyzer.calculate_relevance(query, text, res["url"], terms),
+        "entities": analyzer.extract_entities(text, limit=MAX_ENTITIES)
+    }
+
+async def iter_pages(session: aiohttp.ClientSession, results: List[Dict], query: str,
+                     max_pages: int = MAX_PAGES, deadline: float = FETCH_DEADLINE,
+                     analyzer: "ContentAnalyzer" = None, cache: HTTPCache = HTTP_CACHE) -> AsyncIterator[Dict]:
+    """Scarica tutte le pagine candidate in parallelo e le restituisce man mano che arrivano.
+
+    Si ferma appena ha max_pages pagine rilevanti o allo scadere di deadline."""
+    analyzer = analyzer or ContentAnalyzer()
+    tasks = [asyncio.create_task(fetch_page(session, res, query, analyzer, cache)) for res in results]
+    good = 0
+    try:
+        for next_page in asyncio.as_completed(tasks, timeout=deadline):
+            try:
+                page = await next_page
+            except asyncio.TimeoutError:
+                break
+            if page is None:
                 continue
+            yield page
+            good += page["relevance"] >= GOOD_RELEVANCE
+            if good >= max_pages:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def rank_pages(analyzer: ContentAnalyzer, query: str, pages: List[Dict]) -> List[Dict]:
+    """Ordina le pagine per punteggio BM25 calcolato sull'intero insieme di candidate"""
+    for page, score in zip(pages, analyzer.bm25(query, [p["terms"] for p in pages])):
+        page["score"] = float(score)
+    return sorted(pages, key=lambda p: (p["score"], p["relevance"]), reverse=True)
+
+# --- PIPELINE DI RICERCA ---
+
+def estimate_tokens(text: str) -> int:
+    """Stima grossolana dei token (circa 4 caratteri per token) quando non c'è un tokenizer"""
+    return len(text) // 4 + 1
+
+STAGE_NAMES = {
+    "search": "ricerca",
+    "fetch": "download",
+    "rank": "ordinamento",
+    "chunk": "passaggi",
+    "summarize": "riassunto",
+}
+
+class DeepResearchCore:
+    """Ricerca approfondita a fasi: search → fetch (con estrazione del testo in streaming)
+    → rank → chunk → summarize.
+
+    Ogni fase ha un limite di tempo o di elementi e viene cronometrata. research_stream()
+    restituisce eventi {"stage": ...} man mano che le fasi producono risultati, così
+    l'interfaccia può mostrare le fonti mentre le fasi successive sono ancora in corso.
+
+    Motori e cache si possono sostituire (es. un server HTTP locale e cache=None per
+    provare la pipeline senza rete): ogni motore in engines può indicare il proprio
+    parser, altrimenti si usa quello di ENGINE_SEARCHERS con lo stesso nome. summarizer è una funzione (prompt, timeout) -> pezzi
+    di testo che oltre timeout secondi solleva TimeoutError, come ArcadiaAICore.analizza_stream;
+    senza, il riassunto è fatto dai passaggi migliori.
+    count_tokens misura i passaggi per farli stare in passage_tokens (di default una stima).
+    Se c'è un indice locale (SearchIndex), le pagine lette vi vengono aggiunte per @cerca,
+    a nome di owner."""
+
+    def __init__(self, summarizer: Optional[Callable[[str, float], Iterator[str]]] = None, engines: Dict = None,
+                 cache: Optional[HTTPCache] = HTTP_CACHE, analyzer: ContentAnalyzer = None,
+                 max_candidates: int = MAX_CANDIDATES, max_pages: int = MAX_PAGES, max_passages: int = MAX_PASSAGES,
+                 search_deadline: float = SEARCH_DEADLINE, fetch_deadline: float = FETCH_DEADLINE,
+                 summary_deadline: float = SUMMARY_DEADLINE, count_tokens: Callable[[str], int] = None,
+                 passage_tokens: int = PASSAGE_TOKENS, index: SearchIndex = None,
+                 total_deadline: Optional[float] = None, owner: str = ""):
+        self.summarizer = summarizer
+        self.index = index
+        self.owner = owner
+        self.count_tokens = count_tokens or estimate_tokens
+        self.passage_tokens = passage_tokens
+        self.engines = engines or SEARCH_ENGINES
+        self.cache = cache
+        self.analyzer = analyzer or ContentAnalyzer()
+        self.max_candidates = max_candidates
+        self.max_pages = max_pages
+        self.max_passages = max_passages
+        self.search_deadline = search_deadline
+        self.fetch_deadline = fetch_deadline
+        self.summary_deadline = summary_deadline
+        self.total_deadline = total_deadline  # Limite per l'intera ricerca, riassunto compreso
+
+    # --- Fasi asincrone: search, fetch, rank, chunk ---
 
-        return {
+    async def search(self, query: str, session: aiohttp.ClientSession) -> AsyncIterator[List[Dict]]:
+        """Nuove fonti (deduplicate per dominio) man mano che i motori rispondono"""
+        sources, seen_domains = [], set()
+        async for _, results in search_engines(query, session, self.cache, self.engines, self.search_deadline):
+            before = len(sources)
+            _add_unique(sources, seen_domains, results)
+            if len(sources) > before:
+                yield sources[before:]
+
+    def rank(self, query: str, pages: List[Dict]) -> List[Dict]:
+        """Le max_pages pagine più rilevanti"""
+        return rank_pages(self.analyzer, query, pages)[:self.max_pages]
+
+    @staticmethod
+    def split_passages(text: str, size: int = PASSAGE_WORDS, overlap: int = PASSAGE_OVERLAP) -> List[Tuple[int, str]]:
+        """Finestre di size parole che si sovrappongono di overlap: (parola iniziale, testo)"""
+        words = text.split()
+        step = max(1, size - overlap)
+        return [(start, " ".join(words[start:start + size]))
+                for start in range(0, max(len(words) - overlap, 1), step) if words]
+
+    def chunk(self, query: str, pages: List[Dict]) -> List[Dict]:
+        """I max_passages passaggi più rilevanti delle pagine, con la fonte (numero 1-based in pages).
+
+        Tra passaggi sovrapposti della stessa pagina si tiene solo il migliore."""
+        passages = []
+        for source, page in enumerate(pages, 1):
+            for start, text in self.split_passages(page["text"]):
+                passages.append({"text": text, "source": source, "url": page["url"], "start": start,
+                                 "terms": self.analyzer.term_frequencies(text)})
+        # A parità di punteggio resta l'ordine delle pagine
+        for passage, score in zip(passages, self.analyzer.bm25(query, [p["terms"] for p in passages])):
+            passage["relevance"] = float(score)
+        passages.sort(key=lambda p: p["relevance"], reverse=True)
+        selected = []
+        for passage in passages:
+            if len(selected) >= self.max_passages:
+                break
+            if not any(p["source"] == passage["source"] and abs(p["start"] - passage["start"]) < PASSAGE_WORDS
+                       for p in selected):
+                selected.append(passage)
+        return selected
+
+    def pack(self, passages: List[Dict]) -> List[Dict]:
+        """I passaggi migliori che stanno in passage_tokens, nell'ordine in cui compaiono nelle fonti"""
+        packed, used = [], 0
+        for passage in passages:
+            tokens = self.count_tokens(passage["text"])
+            if used + tokens <= self.passage_tokens:
+                packed.append(passage)
+                used += tokens
+            elif not packed:
+                # Nemmeno il migliore entra per intero: se ne tiene l'inizio
+                words = passage["text"].split()
+                keep = len(words) * self.passage_tokens // tokens
+                if keep:
+                    packed.append({**passage, "text": " ".join(words[:keep])})
+                    used = self.passage_tokens
+        return sorted(packed, key=lambda p: (p["source"], p["start"]))
+
+    async def gather(self, query: str, timings: Dict) -> AsyncIterator[Dict]:
+        """Esegue le fasi asincrone, annotando in timings la durata di ciascuna"""
+        session = get_session()
+
+        start = time.perf_counter()
+        sources = []
+        async for new_sources in self.search(query, session):
+            sources.extend(new_sources)
+            yield {"stage": "search", "sources": new_sources}
+        timings["search"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pages = []
+        async for page in iter_pages(session, sources[:self.max_candidates], query, self.max_pages,
+                                     self.fetch_deadline, self.analyzer, self.cache):
+            pages.append(page)
+            yield {"stage": "fetch", "page": page}
+            if self.index is not None:
+                await asyncio.to_thread(self.index.add, f"page:{page['url']}", page["text"], "page",
+                                        page["title"] or page["url"], owner=self.owner)
+        timings["fetch"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pages = self.rank(query, pages)
+        timings["rank"] = time.perf_counter() - start
+        yield {"stage": "rank", "pages": pages}
+
+        start = time.perf_counter()
+        passages = await asyncio.to_thread(self.chunk, query, pages)
+        timings["chunk"] = time.perf_counter() - start
+        yield {"stage": "chunk", "passages": passages}
+
+    # --- Riassunto e interfaccia sincrona ---
+
+    def summary_prompt(self, query: str, passages: List[Dict]) -> str:
+        excerpts = "\n".join(f"[{p['source']}] {p['text']}" for p in self.pack(passages))
+        return (
+            f"Domanda: {query}\n\n"
+            f"Estratti dalle fonti:\n{excerpts}\n\n"
+            "Rispondi in italiano in poche frasi, usando solo gli estratti e citando le fonti con [numero]."
+        )
+
+    @staticmethod
+    def extractive_summary(passages: List[Dict], n: int = 3) -> str:
+        relevant = [p for p in passages if p["relevance"] > 0] or passages
+        return "\n\n".join(f"> {p['text']} [{p['source']}]" for p in relevant[:n])
+
+    def summarize(self, query: str, passages: List[Dict], timeout: Optional[float] = None) -> Iterator[Dict]:
+        """Riassunto del modello un pezzo alla volta; restituisce (come valore del generatore) il testo completo.
+
+        Se il modello non risponde entro summary_deadline o timeout (attesa in coda compresa), non è
+        disponibile o non produce nulla, si usano i passaggi migliori: l'evento con
+        "replace" sostituisce l'eventuale testo parziale già mostrato."""
+        summary = ""
+        limit = self.summary_deadline if timeout is None else min(self.summary_deadline, timeout)
+        if self.summarizer is not None and passages and limit > 0:
+            deadline = time.perf_counter() + limit
+            chunks = None
+            try:
+                chunks = self.summarizer(self.summary_prompt(query, passages), limit)
+                for delta in chunks:
+                    if time.perf_counter() > deadline:
+                        raise TimeoutError("Tempo scaduto per il riassunto")
+                    summary += delta
+                    yield {"stage": "summarize", "delta": delta}
+            except Exception:
+                summary = ""
+            finally:
+                if hasattr(chunks, "close"):
+                    chunks.close()  # Annulla la generazione se interrotta
+        if not summary.strip():
+            summary = self.extractive_summary(passages)
+            if summary:
+                yield {"stage": "summarize", "delta": summary, "replace": True}
+        return summary.strip()
+
+    def research_stream(self, query: str) -> Iterator[Dict]:
+        """Eventi della ricerca man mano che arrivano; l'ultimo è {"stage": "done", "result": {...}}.
+
+        Se le fasi di rete superano total_deadline solleva TimeoutError; il riassunto
+        usa il tempo che resta."""
+        timings = {}
+        total_start = time.perf_counter()
+        deadline = time.monotonic() + self.total_deadline if self.total_deadline is not None else None
+        pages, passages = [], []
+        item_timeout = self.search_deadline + self.fetch_deadline + 30
+        try:
+            for event in get_worker().iterate(self.gather(query, timings), timeout=item_timeout, deadline=deadline):
+                if event["stage"] == "rank":
+                    pages = event["pages"]
+                elif event["stage"] == "chunk":
+                    passages = event["passages"]
+                yield event
+        except TimeoutError:
+            raise TimeoutError("La ricerca ha impiegato troppo tempo. Riprova.") from None
+        start = time.perf_counter()
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        summary = yield from self.summarize(query, passages, remaining)
+        timings["summarize"] = time.perf_counter() - start
+        timings["total"] = time.perf_counter() - total_start
+        yield {"stage": "done", "result": {
             "query": query,
-            "results": final_results,
-            "count": len(final_results)
-        }
-    except Exception as e:
-        return {"error": str(e), "results": []}
\ No newline at end of file
+            "results": pages,
+            "passages": passages,
+            "summary": summary,
+            "count": len(pages),
+            "timings": timings,
+        }}
+
+    def research(self, query: str, on_event: Callable[[Dict], None] = None) -> str:
+        """Esegue tutta la ricerca e restituisce la risposta formattata"""
+        result = None
+        for event in self.research_stream(query):
+            if on_event is not None:
+                on_event(event)
+            if event["stage"] == "done":
+                result = event["result"]
+        return self.format(result)
+
+    @staticmethod
+    def format(result: Dict) -> str:
+        if not result["results"]:
+            return f"❌ Nessun risultato trovato per: _{result['query']}_"
+        sources = "\n".join(f"{i}. [{p['title'] or p['url']}]({p['url']})" for i, p in enumerate(result["results"], 1))
+        timings = " · ".join(f"{STAGE_NAMES[stage]} {seconds:.1f}s" for stage, seconds in result["timings"].items()
+                             if stage in STAGE_NAMES)
+        return (
+            f"🔍 **Ricerca**: _{result['query']}_\n"
+            f"📊 **Fonti analizzate**: {result['count']}\n\n"
+            f"{result['summary']}\n\n"
+            f"**Fonti:**\n{sources}\n\n"
+            f"⏱️ {timings}"
+        )
@@ -0,0 +1,58 @@
+# core/disk_cache.py
+import os
+import tempfile
+from pathlib import Path
+from typing import Callable, IO, Optional
+
+def write_atomic(path: Path, write: Callable[[IO], None], binary: bool = True) -> int:
+    """Scrive un file in modo atomico e ne restituisce la dimensione.
+
+    write(f) riceve il file temporaneo, creato nella stessa cartella con un nome
+    unico (anche tra thread dello stesso processo) e poi rinominato su path."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f"{path.name}.", suffix=".tmp")
+    try:
+        with (open(fd, "wb") if binary else open(fd, "w", encoding="utf-8")) as f:
+            write(f)
+            f.flush()
+            size = os.fstat(f.fileno()).st_size
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return size
+
+def touch(path: Path):
+    """Segna la voce come usata di recente (LRU)"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass  # Eliminata nel frattempo da un'altra scrittura
+
+def discard(path: Path):
+    """Elimina una voce illeggibile, ignorando gli errori del disco"""
+    try:
+        path.unlink(missing_ok=True)
+    except OSError:
+        pass
+
+def evict(directory: Path, pattern: str, max_bytes: int, target: Optional[int] = None) -> int:
+    """Elimina le voci usate meno di recente finché la cartella supera max_bytes.
+
+    Se serve eliminare, si scende fino a target (di default max_bytes). Restituisce
+    la dimensione totale che resta."""
+    entries = []
+    for path in directory.glob(pattern):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        target = max_bytes if target is None else target
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= target:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+    return total
@@ -0,0 +1,110 @@
+# core/http_cache.py
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+from .disk_cache import discard, evict, touch, write_atomic
+
+# --- CONFIG ---
+CACHE_DIR = Path("cache") / "http"
+MAX_CACHE_BYTES = 256 * 1024 * 1024  # 256 MB
+PAGE_TTL = 24 * 3600      # Pagine scaricate
+SEARCH_TTL = 6 * 3600     # Risultati dei motori di ricerca
+
+class HTTPCache:
+    """Cache su disco delle risposte HTTP già elaborate (testo estratto, risultati di ricerca).
+
+    Ogni voce è un file JSON il cui nome è l'hash della richiesta; contiene il
+    contenuto elaborato, la scadenza (TTL) e gli header ETag/Last-Modified per la
+    rivalidazione condizionale. Oltre max_bytes si eliminano le voci meno usate.
+
+    Un errore del disco non interrompe mai chi usa la cache: get() restituisce None e
+    put()/refresh() non salvano nulla, come se la voce non ci fosse."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._size = None  # Dimensione totale stimata, calcolata alla prima scrittura
+
+    @staticmethod
+    def key(*parts) -> str:
+        raw = "\x00".join(str(p) for p in parts)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    @staticmethod
+    def is_fresh(entry: Dict) -> bool:
+        return time.time() - entry["stored_at"] < entry["ttl"]
+
+    @staticmethod
+    def validators(entry: Optional[Dict]) -> Dict:
+        """Header per una richiesta condizionale basata sulla voce in cache"""
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def get(self, key) -> Optional[Dict]:
+        """Voce in cache (anche scaduta, per rivalidarla) o None"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            discard(path)
+            return None
+        touch(path)
+        return entry
+
+    def put(self, key, payload, ttl, etag=None, last_modified=None):
+        entry = {
+            "stored_at": time.time(),
+            "ttl": ttl,
+            "etag": etag,
+            "last_modified": last_modified,
+            "payload": payload,
+        }
+        self._write(key, entry)
+
+    def refresh(self, key, entry: Dict, ttl=None):
+        """Il server ha risposto 304: la voce torna valida per un altro TTL"""
+        entry["stored_at"] = time.time()
+        if ttl is not None:
+            entry["ttl"] = ttl
+        self._write(key, entry)
+
+    def _write(self, key, entry):
+        try:
+            self._write_entry(key, entry)
+        except OSError:
+            pass  # La cache è solo un'ottimizzazione
+
+    def _write_entry(self, key, entry):
+        path = self._path(key)
+        path.parent.mkdir(exist_ok=True)
+        try:
+            old_size = path.stat().st_size
+        except FileNotFoundError:
+            old_size = 0
+        new_size = write_atomic(path, lambda f: json.dump(entry, f, ensure_ascii=False), binary=False)
+        if self._size is None:
+            self._evict()
+        else:
+            self._size += new_size - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Ricalcola la dimensione della cache ed elimina le voci meno usate oltre il limite"""
+        # Scendi un po' sotto il limite, per non ripetere la scansione a ogni scrittura
+        self._size = evict(self.cache_dir, "*/*.json", self.max_bytes, target=self.max_bytes * 0.9)
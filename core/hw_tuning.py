@@ -0,0 +1,188 @@
+# core/hw_tuning.py
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+# --- CONFIG ---
+TUNING_FILE = Path("models") / "tuning.json"
+CALIBRATION_TEXT = (
+    "ArcadiaAI è un chatbot libero e open source. Questo testo serve solo a misurare "
+    "la velocità del modello su questa macchina: valutazione del prompt e generazione. "
+) * 8
+DECODE_TOKENS = 32
+BATCH_SIZES = (128, 256, 512)
+
+# --- PROBE HARDWARE ---
+
+def _physical_cores():
+    """Core fisici (senza hyper-threading) tra le CPU utilizzabili dal processo"""
+    try:
+        import psutil
+        cores = psutil.cpu_count(logical=False)
+        if cores:
+            return cores
+    except ImportError:
+        pass
+    try:
+        cores = set()
+        physical_id = core_id = None
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("physical id"):
+                    physical_id = line.split(":")[1].strip()
+                elif line.startswith("core id"):
+                    core_id = line.split(":")[1].strip()
+                elif not line.strip() and core_id is not None:
+                    cores.add((physical_id, core_id))
+                    physical_id = core_id = None
+        if core_id is not None:
+            cores.add((physical_id, core_id))
+        if cores:
+            return len(cores)
+    except OSError:
+        pass
+    return max(1, (os.cpu_count() or 2) // 2)
+
+def _available_ram():
+    """RAM disponibile in byte, o None se non si riesce a leggerla"""
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        pass
+    try:
+        with open("/proc/meminfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _gpu_offload():
+    try:
+        import llama_cpp
+        return bool(llama_cpp.llama_supports_gpu_offload())
+    except (ImportError, AttributeError):
+        return False
+
+def detect_hardware() -> dict:
+    """Core fisici, CPU utilizzabili, RAM disponibile e supporto GPU"""
+    try:
+        usable = len(os.sched_getaffinity(0))
+    except AttributeError:
+        usable = os.cpu_count() or 1
+    return {
+        "physical_cores": min(_physical_cores(), usable),
+        "logical_cpus": usable,
+        "available_ram": _available_ram(),
+        "gpu_offload": _gpu_offload(),
+    }
+
+# --- IMPOSTAZIONI ---
+
+def _model_id(model_path):
+    st = os.stat(model_path)
+    return f"{Path(model_path).name}:{st.st_size}:{int(st.st_mtime)}"
+
+def load_settings(model_path, tuning_file=TUNING_FILE):
+    """Impostazioni calibrate per questo modello su questa macchina, o None"""
+    try:
+        with open(tuning_file, "r", encoding="utf-8") as f:
+            return json.load(f).get(_model_id(model_path))
+    except (OSError, ValueError):
+        return None
+
+def save_settings(model_path, settings, tuning_file=TUNING_FILE):
+    tuning_file = Path(tuning_file)
+    data = {}
+    if tuning_file.exists():
+        try:
+            with open(tuning_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except ValueError:
+            pass
+    data[_model_id(model_path)] = settings
+    tmp = tuning_file.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, tuning_file)
+
+def default_settings(model_path, hardware=None) -> dict:
+    """Impostazioni per il modello: quelle calibrate se esistono, altrimenti stimate dall'hardware"""
+    hardware = hardware or detect_hardware()
+    ram = hardware["available_ram"]
+    settings = {
+        # La generazione è limitata dalla banda di memoria: oltre i core fisici peggiora
+        "n_threads": hardware["physical_cores"],
+        "n_threads_batch": hardware["logical_cpus"],
+        "n_batch": 512,
+        "n_gpu_layers": -1 if hardware["gpu_offload"] else 0,
+        "use_mmap": True,
+        # Blocca il modello in RAM (niente page fault dopo l'inattività) solo se c'è ampio margine
+        "use_mlock": ram is not None and ram > 2 * os.path.getsize(model_path),
+    }
+    tuned = load_settings(model_path)
+    if tuned:
+        settings.update({k: tuned[k] for k in settings if k in tuned})
+    return settings
+
+# --- CALIBRAZIONE ---
+
+def _thread_candidates(hardware):
+    cores, logical = hardware["physical_cores"], hardware["logical_cpus"]
+    candidates = {max(1, cores // 2), max(1, cores - 1), cores, logical}
+    candidates.update(n for n in (4, 8, 16) if n <= logical)
+    return sorted(candidates)
+
+def calibrate(model_path, n_ctx=4096, batch_sizes=BATCH_SIZES, thread_counts=None, save=True, log=print) -> dict:
+    """Misura valutazione del prompt e generazione al variare di thread e n_batch.
+
+    Sceglie separatamente i thread migliori per la generazione (n_threads) e per
+    il prompt (n_threads_batch), e salva il risultato per il modello."""
+    import llama_cpp
+    from llama_cpp import Llama
+
+    hardware = detect_hardware()
+    thread_counts = thread_counts or _thread_candidates(hardware)
+    best = {"pp_tps": 0.0, "tg_tps": 0.0}
+    for n_batch in batch_sizes:
+        model = Llama(model_path=str(model_path), n_ctx=n_ctx, n_batch=n_batch,
+                      n_gpu_layers=0, verbose=False)
+        tokens = model.tokenize(CALIBRATION_TEXT.encode("utf-8"))
+        for n_threads in thread_counts:
+            llama_cpp.llama_set_n_threads(model.ctx, n_threads, n_threads)
+            # Valutazione del prompt
+            model.reset()
+            start = time.perf_counter()
+            model.eval(tokens)
+            pp_tps = len(tokens) / (time.perf_counter() - start)
+            # Generazione: un token alla volta
+            start = time.perf_counter()
+            for _ in range(DECODE_TOKENS):
+                model.eval([model.token_bos()])
+            tg_tps = DECODE_TOKENS / (time.perf_counter() - start)
+            log(f"n_batch={n_batch:4d} threads={n_threads:3d}  prompt {pp_tps:8.1f} tok/s  generazione {tg_tps:6.1f} tok/s")
+            if pp_tps > best["pp_tps"]:
+                best.update(pp_tps=pp_tps, n_threads_batch=n_threads, n_batch=n_batch)
+            if tg_tps > best["tg_tps"]:
+                best.update(tg_tps=tg_tps, n_threads=n_threads)
+        del model
+    best.update(
+        n_gpu_layers=-1 if hardware["gpu_offload"] else 0,
+        calibrated_at=time.strftime("%Y-%m-%dT%H:%M:%S"),
+    )
+    if save:
+        save_settings(model_path, best)
+    return best
+
+if __name__ == "__main__":
+    # Uso: python -m core.hw_tuning models/modello.gguf
+    if len(sys.argv) != 2:
+        print("Uso: python -m core.hw_tuning <modello.gguf>")
+        sys.exit(1)
+    print(detect_hardware())
+    result = calibrate(sys.argv[1])
+    print(f"Impostazioni salvate in {TUNING_FILE}: {result}")
@@ -1,16 +1,130 @@
 # core/local_llm.py
+import threading
+
 from llama_cpp import Llama 
 
+from .hw_tuning import default_settings
+from .prompt_cache import PromptStateCache
+
 class LocalLLM:
-    def __init__(self, model_path, n_ctx=4096, n_threads=6, n_gpu_layers=40):
+    def __init__(self, model_path, n_ctx=4096, n_threads=None, n_gpu_layers=None, use_state_cache=True,
+                 n_threads_batch=None, n_batch=None, use_mmap=None, use_mlock=None):
+        """I parametri lasciati a None vengono dalla calibrazione salvata per il modello
+        (python -m core.hw_tuning) o, in mancanza, dai core e dalla GPU rilevati"""
+        self.model_path = str(model_path)
+        self.n_ctx = n_ctx
+        self.state_cache = PromptStateCache() if use_state_cache else None
+        settings = default_settings(model_path)
+        explicit = {
+            "n_threads": n_threads,
+            "n_threads_batch": n_threads_batch,
+            "n_batch": n_batch,
+            "n_gpu_layers": n_gpu_layers,
+            "use_mmap": use_mmap,
+            "use_mlock": use_mlock,
+        }
+        settings.update({k: v for k, v in explicit.items() if v is not None})
+        self.settings = settings
         self.model = Llama(
             model_path=model_path,
             n_ctx=n_ctx,
-            n_threads=n_threads,
-            n_gpu_layers=n_gpu_layers,
-            verbose=False
+            verbose=False,
+            **settings
         )
+        # Llama non è thread-safe: il modello può essere condiviso tra più sessioni
+        self.lock = threading.RLock()
+        # Stato KV del prompt di sistema, punto di partenza comune a tutte le conversazioni
+        self.system_prompt = None
+        self._system_tokens = []
+        self._system_state = None
+
+    def tokenize(self, text, add_bos=True):
+        return self.model.tokenize(text.encode("utf-8"), add_bos=add_bos, special=True)
+
+    def set_system_prompt(self, system_prompt):
+        """Valuta una sola volta il prompt di sistema e ne conserva lo stato KV"""
+        with self.lock:
+            self._set_system_prompt(system_prompt)
+
+    def _set_system_prompt(self, system_prompt):
+        if system_prompt == self.system_prompt:
+            return
+        tokens = self.tokenize(system_prompt)
+        state = None
+        if self.state_cache is not None:
+            # Sessione "fredda": riparti dallo stato salvato su disco, se c'è
+            key = self.state_cache.key(self.model_path, self.n_ctx, tokens)
+            state = self.state_cache.get(key)
+        if state is not None:
+            self.model.load_state(state)
+        else:
+            self.model.reset()
+            self.model.eval(tokens)
+            state = self.model.save_state()
+            if self.state_cache is not None:
+                try:
+                    self.state_cache.put(key, state)
+                except OSError:
+                    pass  # La cache su disco è solo un'ottimizzazione
+        self._system_state = state
+        self._system_tokens = tokens
+        self.system_prompt = system_prompt
+
+    def count_tokens(self, text):
+        """Numero di token del testo (senza BOS)"""
+        return len(self.tokenize(text, add_bos=False)) if text else 0
+
+    def truncate(self, text, max_tokens):
+        """Accorcia il testo ai primi max_tokens token"""
+        tokens = self.tokenize(text, add_bos=False)
+        if len(tokens) <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+        return self.model.detokenize(tokens[:max_tokens]).decode("utf-8", errors="ignore")
+
+    @property
+    def system_tokens(self):
+        return self._system_tokens
+
+    def prompt_tokens(self, prompt):
+        """Tokenizza il prompt; il prompt di sistema viene tokenizzato a parte,
+        così i suoi token restano identici a ogni turno"""
+        if self.system_prompt and prompt.startswith(self.system_prompt):
+            return self._system_tokens + self.tokenize(prompt[len(self.system_prompt):], add_bos=False)
+        return self.tokenize(prompt)
+
+    def _prepare(self, prompt):
+        """Tokenizza il prompt e riparte dal prefisso già valutato più lungo.
+
+        Llama.generate riusa la cache KV fino al primo token diverso e valuta
+        solo il suffisso nuovo."""
+        tokens = self.prompt_tokens(prompt)
+        if self._system_state is not None:
+            n_system = len(self._system_tokens)
+            evaluated = self.model.input_ids[:self.model.n_tokens].tolist()
+            shared = Llama.longest_token_prefix(evaluated, tokens)
+            if shared < n_system and tokens[:n_system] == self._system_tokens:
+                # La cache contiene un altro testo: ripristina lo stato del prompt di sistema
+                self.model.load_state(self._system_state)
+        return tokens
 
     def generate(self, prompt, max_tokens=512, temperature=0.7):
-        output = self.model(prompt, max_tokens=max_tokens, temperature=temperature)
-        return output["choices"][0]["text"].strip()
\ No newline at end of file
+        with self.lock:
+            tokens = self._prepare(prompt)
+            output = self.model(tokens, max_tokens=max_tokens, temperature=temperature)
+        return output["choices"][0]["text"].strip()
+
+    def generate_stream(self, prompt, max_tokens=512, temperature=0.7):
+        """Genera la risposta un pezzo alla volta (delta di testo) man mano che i token arrivano"""
+        with self.lock:
+            tokens = self._prepare(prompt)
+            started = False
+            for chunk in self.model(tokens, max_tokens=max_tokens, temperature=temperature, stream=True):
+                delta = chunk["choices"][0]["text"]
+                if not started:
+                    # Come generate(): niente spazi iniziali
+                    delta = delta.lstrip()
+                    started = bool(delta)
+                if delta:
+                    yield delta
@@ -1,18 +1,43 @@
 # core/memory.py
+import atexit
 import json
 import os
+import sqlite3
+import threading
+import weakref
+from contextlib import contextmanager
+from collections import Counter
 from datetime import datetime
 from pathlib import Path
 
+from . import bm25
+
 # --- CONFIG ---
 MEMORY_DIR = Path("memory")
 MEMORY_DIR.mkdir(exist_ok=True)
+FSYNC_INTERVAL = 1.0     # Secondi massimi tra una scrittura nel journal e il suo fsync
+FSYNC_BATCH = 32         # Modifiche oltre le quali si fa subito fsync
+COMPACT_ENTRIES = 1000   # Modifiche nel journal oltre le quali si riscrive lo snapshot
+MEMORY_BACKEND = "json"  # "json" (snapshot + journal per utente) oppure "sqlite"
+SQLITE_PATH = MEMORY_DIR / "memory.db"
+SQLITE_TIMEOUT = 10.0    # Secondi di attesa se un altro processo sta scrivendo
+FLUSH_DELAY = 1.0        # Secondi prima di scrivere le modifiche in sospeso
+MAX_DIRTY = 64           # Percorsi modificati oltre i quali si scrive subito
+MEMORY_TOKENS = 256      # Token del prompt riservati ai fatti ricordati
+MAX_FACTS = 8
+LOG_FILE = MEMORY_DIR / "log.jsonl"
+MAX_LOG_BYTES = 1024 * 1024
+LOG_BACKUPS = 3
+LOG_BUFFER = 64          # Righe del registro accumulate prima di scriverle
+LOG_FLUSH_INTERVAL = 2.0
 
 def set_nested(d, path, value):
     """Imposta un valore annidato: set_nested(data, 'user.preferences.food', 'pizza')"""
     keys = path.split('.')
     for key in keys[:-1]:
-        d = d.setdefault(key, {})
+        if not isinstance(d.get(key), dict):
+            d[key] = {}  # Un valore semplice sul percorso diventa un nodo
+        d = d[key]
     d[keys[-1]] = value
 
 def get_nested(d, path, default=None):
@@ -25,23 +50,534 @@ def get_nested(d, path, default=None):
             return default
     return d
 
+def delete_nested(d, path):
+    """Rimuove un valore annidato; False se non esiste"""
+    keys = path.split('.')
+    for key in keys[:-1]:
+        d = d.get(key) if isinstance(d, dict) else None
+    if isinstance(d, dict) and keys[-1] in d:
+        del d[keys[-1]]
+        return True
+    return False
+
+def _fsync_dir(path: Path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return  # Non supportato (es. Windows)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class JournalStore:
+    """Backend "json": memoria su disco come snapshot JSON più un journal di modifiche (solo aggiunte).
+
+    Ogni modifica è una riga del journal: scriverla costa lo stesso qualunque sia la
+    dimensione della memoria. Gli fsync sono raggruppati (al più ogni FSYNC_INTERVAL
+    secondi o FSYNC_BATCH modifiche). Ogni COMPACT_ENTRIES modifiche lo snapshot viene
+    riscritto su un file temporaneo e sostituito in modo atomico, poi il journal si
+    svuota. Le modifiche sono idempotenti: se ci si interrompe tra i due passaggi,
+    rileggere il journal sullo snapshot nuovo dà lo stesso risultato.
+
+    Lo stato vive nel dizionario di MemoryManager: adatto a una sessione per utente."""
+
+    live = False  # Le letture si fanno sul dizionario in memoria
+
+    def __init__(self, snapshot_path: Path):
+        self.snapshot_path = Path(snapshot_path)
+        self.journal_path = self.snapshot_path.with_suffix(".journal")
+        self._lock = threading.RLock()
+        self._journal = None
+        self._entries = 0      # Modifiche nel journal dall'ultimo snapshot
+        self._unsynced = 0     # Modifiche scritte ma non ancora su disco (fsync)
+        self._sync_timer = None
+
+    def load(self, default):
+        """Snapshot (o default() se manca) con applicate le modifiche del journal"""
+        with self._lock:
+            data = None
+            if self.snapshot_path.exists():
+                try:
+                    with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                except (OSError, ValueError):
+                    data = None
+            if data is None:
+                data = default()
+            self._entries = self._replay(data)
+            return data
+
+    def _replay(self, data) -> int:
+        if not self.journal_path.exists():
+            return 0
+        entries = 0
+        valid = 0
+        with open(self.journal_path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break  # Riga troncata da un'interruzione: da qui in poi niente è affidabile
+                try:
+                    self.apply(data, json.loads(line))
+                except ValueError:
+                    break
+                valid += len(line)
+                entries += 1
+        if valid != self.journal_path.stat().st_size:
+            with open(self.journal_path, "r+b") as f:
+                f.truncate(valid)
+        return entries
+
+    @staticmethod
+    def apply(data, entry):
+        if entry["op"] == "set":
+            set_nested(data, entry["path"], entry["value"])
+        elif entry["op"] == "delete":
+            delete_nested(data, entry["path"])
+        elif entry["op"] == "batch":
+            for sub in entry["entries"]:
+                JournalStore.apply(data, sub)
+        if "ts" in entry and isinstance(data.get("system"), dict):
+            data["system"]["updated_at"] = entry["ts"]
+
+    def write(self, entries, ts, data=None):
+        """Registra le modifiche nel journal: più modifiche insieme diventano una sola riga,
+        applicata per intero o per niente. Con data, compatta quando il journal è lungo."""
+        entry = dict(entries[0]) if len(entries) == 1 else {"op": "batch", "entries": entries}
+        entry["ts"] = ts
+        line = json.dumps(entry, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, "a", encoding="utf-8")
+            self._journal.write(line)
+            self._journal.flush()
+            self._entries += 1
+            self._unsynced += 1
+            if self._unsynced >= FSYNC_BATCH:
+                self.sync()
+            elif self._sync_timer is None:
+                self._sync_timer = threading.Timer(FSYNC_INTERVAL, self.sync)
+                self._sync_timer.daemon = True
+                self._sync_timer.start()
+            if data is not None and self._entries >= COMPACT_ENTRIES:
+                self.compact(data)
+
+    def sync(self):
+        """Porta su disco le modifiche scritte nel journal"""
+        with self._lock:
+            if self._sync_timer is not None:
+                self._sync_timer.cancel()
+                self._sync_timer = None
+            if self._journal is not None and self._unsynced:
+                os.fsync(self._journal.fileno())
+            self._unsynced = 0
+
+    def compact(self, data):
+        """Riscrive lo snapshot con lo stato attuale e svuota il journal"""
+        with self._lock:
+            tmp = self.snapshot_path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.snapshot_path)
+            _fsync_dir(self.snapshot_path.parent)
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            with open(self.journal_path, "w", encoding="utf-8"):
+                pass  # Svuota il journal: tutto è nello snapshot
+            self._entries = 0
+            self.sync()
+
+    def clear(self):
+        with self._lock:
+            self.sync()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            for path in (self.snapshot_path, self.journal_path):
+                if path.exists():
+                    os.remove(path)
+            self._entries = 0
+
+    def close(self):
+        with self._lock:
+            self.sync()
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+def flatten(value, path=""):
+    """Coppie (percorso puntato, valore) delle foglie; i dizionari vuoti restano foglie"""
+    if isinstance(value, dict) and value:
+        for key, child in value.items():
+            yield from flatten(child, f"{path}.{key}" if path else key)
+    else:
+        yield path, value
+
+def _prefix_range(path):
+    # Tutti i percorsi che iniziano con "path.": "/" è il carattere che segue "."
+    return path + ".", path + "/"
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+def _sqlite_connection(db_path):
+    """Connessione SQLite condivisa dal processo (con il suo lock) per ogni database"""
+    db_path = str(db_path)
+    with _connections_lock:
+        if db_path not in _connections:
+            conn = sqlite3.connect(db_path, timeout=SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS memory ("
+                " user_id TEXT NOT NULL, path TEXT NOT NULL, value TEXT NOT NULL,"
+                " PRIMARY KEY (user_id, path)) WITHOUT ROWID"
+            )
+            _connections[db_path] = (conn, threading.RLock())
+        return _connections[db_path]
+
+class SQLiteStore:
+    """Backend "sqlite": una riga per foglia (percorso puntato -> valore JSON) in un unico
+    database in modalità WAL, condiviso da tutti gli utenti.
+
+    La chiave primaria (user_id, path) fa da indice sia per i percorsi esatti sia per
+    le ricerche per prefisso (user.preferences.*). Ogni gruppo di modifiche è una
+    transazione (BEGIN IMMEDIATE): più sessioni e processi possono scrivere sullo stesso
+    utente senza sovrascriversi a vicenda, e le letture vedono sempre dati consistenti."""
+
+    live = True  # Le letture vanno al database: vedono le modifiche delle altre sessioni
+
+    def __init__(self, user_id, db_path=SQLITE_PATH):
+        self.user_id = user_id
+        self._conn, self._lock = _sqlite_connection(db_path)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _rows(self, path=None):
+        with self._lock:
+            if path is None:
+                return self._conn.execute("SELECT path, value FROM memory WHERE user_id = ?",
+                                          (self.user_id,)).fetchall()
+            low, high = _prefix_range(path)
+            return self._conn.execute(
+                "SELECT path, value FROM memory WHERE user_id = ? AND (path = ? OR (path >= ? AND path < ?))",
+                (self.user_id, path, low, high)).fetchall()
+
+    def load(self, default):
+        rows = self._rows()
+        if not rows:
+            data = default()
+            with self._transaction() as conn:
+                conn.executemany("INSERT OR IGNORE INTO memory VALUES (?, ?, ?)",
+                                 [(self.user_id, p, json.dumps(v, ensure_ascii=False)) for p, v in flatten(data)])
+            rows = self._rows()
+        data = {}
+        for path, value in rows:
+            set_nested(data, path, json.loads(value))
+        return data
+
+    def get(self, path, default=None):
+        rows = self._rows(path)
+        if not rows:
+            return default
+        if len(rows) == 1 and rows[0][0] == path:
+            return json.loads(rows[0][1])
+        value = {}
+        for row_path, row_value in rows:
+            set_nested(value, row_path[len(path) + 1:], json.loads(row_value))
+        return value
+
+    def query(self, prefix):
+        """Foglie sotto il prefisso ("user.preferences" o "user.preferences.*"): {percorso: valore}"""
+        prefix = prefix[:-2] if prefix.endswith(".*") else prefix
+        return {path: json.loads(value) for path, value in self._rows(prefix)}
+
+    def _delete(self, conn, path):
+        low, high = _prefix_range(path)
+        conn.execute("DELETE FROM memory WHERE user_id = ? AND (path = ? OR (path >= ? AND path < ?))",
+                     (self.user_id, path, low, high))
+
+    def _set(self, conn, path, value):
+        self._delete(conn, path)
+        # Un antenato che era una foglia diventa un nodo
+        keys = path.split(".")
+        ancestors = [".".join(keys[:i]) for i in range(1, len(keys))]
+        conn.executemany("DELETE FROM memory WHERE user_id = ? AND path = ?",
+                         [(self.user_id, a) for a in ancestors])
+        conn.executemany("INSERT INTO memory VALUES (?, ?, ?)",
+                         [(self.user_id, p, json.dumps(v, ensure_ascii=False)) for p, v in flatten(value, path)])
+
+    def write(self, entries, ts, data=None):
+        """Applica tutte le modifiche in una sola transazione"""
+        with self._transaction() as conn:
+            for entry in entries:
+                if entry["op"] == "set":
+                    self._set(conn, entry["path"], entry["value"])
+                elif entry["op"] == "delete":
+                    self._delete(conn, entry["path"])
+            self._set(conn, "system.updated_at", ts)
+
+    def sync(self):
+        pass  # Ogni transazione è già nel WAL
+
+    def compact(self, data):
+        """Sostituisce tutte le righe dell'utente con lo stato dato"""
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM memory WHERE user_id = ?", (self.user_id,))
+            conn.executemany("INSERT INTO memory VALUES (?, ?, ?)",
+                             [(self.user_id, p, json.dumps(v, ensure_ascii=False)) for p, v in flatten(data)])
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM memory WHERE user_id = ?", (self.user_id,))
+
+    def close(self):
+        pass  # La connessione è condivisa dal processo
+
+BACKENDS = {
+    "json": lambda user_id: JournalStore(MEMORY_DIR / f"{user_id}.json"),
+    "sqlite": lambda user_id: SQLiteStore(user_id),
+}
+
+class ChangeLog:
+    """Registro delle modifiche alla memoria in formato JSON Lines, solo aggiunte.
+
+    Le righe si accumulano in memoria e vengono scritte a gruppi (LOG_BUFFER righe,
+    al più dopo LOG_FLUSH_INTERVAL secondi) con una sola write in append. Oltre
+    MAX_LOG_BYTES il file ruota in log.jsonl.1, .2, ... (se ne tengono LOG_BACKUPS).
+    tail() legge i file a ritroso, un blocco alla volta, senza caricarli interi."""
+
+    def __init__(self, path=LOG_FILE, max_bytes=MAX_LOG_BYTES, backups=LOG_BACKUPS):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        self._buffer = []
+        self._timer = None
+        self._migrate_legacy()
+
+    def _migrate_legacy(self):
+        """Importa il vecchio log.json (lista JSON riscritta a ogni modifica), se c'è"""
+        legacy = self.path.with_name("log.json")
+        if not legacy.exists() or self.path.exists():
+            return
+        try:
+            with open(legacy, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+            self._write("".join(json.dumps(e, ensure_ascii=False) + "\n" for e in entries))
+        except (OSError, ValueError, TypeError):
+            pass
+        legacy.unlink(missing_ok=True)
+
+    def append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= LOG_BUFFER:
+                self._flush()
+            elif self._timer is None:
+                self._timer = threading.Timer(LOG_FLUSH_INTERVAL, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._buffer:
+            data, self._buffer = "".join(self._buffer), []
+            self._write(data)
+
+    def _write(self, data):
+        # O_APPEND: le righe di processi diversi non si sovrascrivono
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+            size = f.tell()
+        if size > self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f"{self.path.name}.{i}")
+            if older.exists():
+                os.replace(older, self.path.with_name(f"{self.path.name}.{i + 1}"))
+        if self.path.exists():
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+
+    @staticmethod
+    def _lines_backwards(path, block=8192):
+        """Righe del file dall'ultima alla prima, leggendo a blocchi dalla fine"""
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with f:
+            position = f.seek(0, os.SEEK_END)
+            rest = b""
+            while position > 0:
+                step = min(block, position)
+                position -= step
+                f.seek(position)
+                lines = (f.read(step) + rest).split(b"\n")
+                rest = lines.pop(0)  # Può essere incompleta: si completa col blocco precedente
+                for line in reversed(lines):
+                    if line:
+                        yield line
+            if rest:
+                yield rest
+
+    def tail(self, n=100, user=None):
+        """Ultime n voci (eventualmente di un solo utente), dalla più vecchia alla più recente"""
+        with self._lock:
+            pending = list(self._buffer)
+        entries = []
+        files = [self.path] + [self.path.with_name(f"{self.path.name}.{i}") for i in range(1, self.backups + 1)]
+        sources = [reversed([line.encode("utf-8") for line in pending])]
+        sources += [self._lines_backwards(path) for path in files]
+        for source in sources:
+            for line in source:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if user is None or entry.get("user") == user:
+                    entries.append(entry)
+                    if len(entries) >= n:
+                        return entries[::-1]
+        return entries[::-1]
+
+class FactIndex:
+    """Indice lessicale (BM25) dei fatti in memoria, per richiamare solo quelli utili.
+
+    Un fatto è una foglia sotto le sezioni indicizzate, resa come testo
+    ("preferences food: pizza"). L'indice si aggiorna a ogni modifica,
+    senza ricostruirlo."""
+
+    SECTIONS = ("user", "conversations")
+
+    def __init__(self, k1=bm25.K1, b=bm25.B):
+        self.k1 = k1
+        self.b = b
+        self.facts = {}     # percorso -> (testo, frequenze dei termini)
+        self.postings = {}  # termine -> percorsi che lo contengono
+        self.total_length = 0
+
+    @staticmethod
+    def render(path, value) -> str:
+        words = " ".join(path.split(".")[1:])
+        shown = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        return f"{words}: {shown}"
+
+    def rebuild(self, data):
+        self.facts, self.postings, self.total_length = {}, {}, 0
+        for section in self.SECTIONS:
+            if isinstance(data.get(section), dict):
+                for path, value in flatten(data[section], section):
+                    self._add(path, value)
+
+    def set(self, path, value):
+        if path.split(".")[0] not in self.SECTIONS:
+            return
+        self.remove(path)
+        keys = path.split(".")
+        for i in range(1, len(keys)):
+            self._discard(".".join(keys[:i]))  # Un antenato che era una foglia ora è un nodo
+        for leaf, leaf_value in flatten(value, path):
+            self._add(leaf, leaf_value)
+
+    def remove(self, path):
+        for fact in [f for f in self.facts if f == path or f.startswith(path + ".")]:
+            self._discard(fact)
+
+    def _add(self, path, value):
+        if value in (None, "", [], {}) or path.count(".") == 0:
+            return
+        text = self.render(path, value)
+        terms = Counter(bm25.tokenize(text))
+        self.facts[path] = (text, terms)
+        self.total_length += sum(terms.values())
+        for term in terms:
+            self.postings.setdefault(term, set()).add(path)
+
+    def _discard(self, path):
+        fact = self.facts.pop(path, None)
+        if fact is None:
+            return
+        self.total_length -= sum(fact[1].values())
+        for term in fact[1]:
+            self.postings[term].discard(path)
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def search(self, query, k=5):
+        """I k fatti più pertinenti alla query: [(punteggio, testo)]"""
+        terms = set(bm25.tokenize(query))
+        n = len(self.facts)
+        if not n or not terms:
+            return []
+        avgdl = max(self.total_length / n, 1.0)
+        scores = Counter()
+        for term in terms & self.postings.keys():
+            paths = self.postings[term]
+            idf = bm25.idf(n, len(paths))
+            for path in paths:
+                _, tf_map = self.facts[path]
+                scores[path] += float(bm25.weight(tf_map[term], idf, sum(tf_map.values()), avgdl, self.k1, self.b))
+        return [(score, self.facts[path][0]) for path, score in scores.most_common(k)]
+
+def _overlaps(a, b):
+    """True se un percorso contiene l'altro (o sono uguali)"""
+    return a == b or a.startswith(b + ".") or b.startswith(a + ".")
+
 class MemoryManager:
-    def __init__(self, user_id="default"):
+    """Memoria a lungo termine di un utente.
+
+    Le modifiche vengono applicate subito al dizionario in memoria e scritte nel backend
+    in differita (write-behind): le modifiche allo stesso percorso si accorpano e vengono
+    salvate insieme dopo FLUSH_DELAY secondi, oltre MAX_DIRTY percorsi modificati, alla
+    chiusura del processo, oppure con flush() o all'uscita da un blocco with."""
+
+    def __init__(self, user_id="default", backend=MEMORY_BACKEND):
+        """backend: "json" (file per utente), "sqlite" (database condiviso) o un oggetto store"""
         self.user_id = user_id
         self.storage_key = MEMORY_DIR / f"{user_id}.json"
+        self.store = BACKENDS[backend](user_id) if isinstance(backend, str) else backend
         self.data = {}
+        self._dirty = {}  # percorso -> ultima modifica non ancora scritta, in ordine
+        self.facts = FactIndex()
+        self._lock = threading.RLock()
+        self._flush_timer = None
         self.load()
+        _managers.add(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
 
     def load(self):
-        """Carica la memoria dal file"""
-        if not self.storage_key.exists():
-            self.data = self.default_memory()
-            return
-        try:
-            with open(self.storage_key, 'r', encoding='utf-8') as f:
-                self.data = json.load(f)
-        except Exception:
-            self.data = self.default_memory()
+        """Carica la memoria dal backend"""
+        with self._lock:
+            self._dirty.clear()
+            self.data = self.store.load(self.default_memory)
+            self.facts.rebuild(self.data)
 
     def default_memory(self):
         return {
@@ -55,61 +591,179 @@ class MemoryManager:
             }
         }
 
+    def _read(self, path, default=None):
+        with self._lock:
+            if self.store.live:
+                if any(_overlaps(path, dirty) for dirty in self._dirty):
+                    self.flush()  # Il database deve vedere anche le modifiche in sospeso
+                return self.store.get(path, default)
+            return get_nested(self.data, path, default)
+
     def update(self, path, value):
         """Aggiorna un campo nella memoria"""
+        return self.update_many({path: value})
+
+    def update_many(self, values):
+        """Aggiorna più campi insieme: le modifiche vengono salvate tutte o nessuna"""
         if not self.is_enabled():
             return False
-        set_nested(self.data, path, value)
-        self.log_change("update", path, value)
-        self.save()
+        # Il timer di scrittura legge self.data: modifica e registrazione sono un solo passo
+        with self._lock:
+            for path, value in values.items():
+                set_nested(self.data, path, value)
+            self._record([{"op": "set", "path": path, "value": value} for path, value in values.items()])
+        for path, value in values.items():
+            self.log_change("update", path, value)
         return True
 
     def get(self, path, default=None):
         """Legge un valore dalla memoria"""
         if not self.is_enabled():
             return default
-        return get_nested(self.data, path, default)
+        return self._read(path, default)
+
+    def query(self, prefix):
+        """Tutte le foglie sotto un prefisso, es. query("user.preferences.*") -> {percorso: valore}"""
+        prefix = prefix[:-2] if prefix.endswith(".*") else prefix
+        with self._lock:
+            if self.store.live:
+                if any(_overlaps(prefix, dirty) for dirty in self._dirty):
+                    self.flush()
+                return self.store.query(prefix)
+            value = get_nested(self.data, prefix)
+            return dict(flatten(value, prefix)) if value is not None else {}
+
+    def relevant_facts(self, message, max_tokens=MEMORY_TOKENS, count_tokens=None, k=MAX_FACTS):
+        """I fatti più pertinenti al messaggio che stanno in max_tokens (count_tokens misura il testo)"""
+        if not self.is_enabled():
+            return []
+        count_tokens = count_tokens or (lambda text: len(text) // 4 + 1)
+        with self._lock:
+            ranked = self.facts.search(message, k)
+        facts, used = [], 0
+        for _, text in ranked:
+            n = count_tokens(text)
+            if used + n <= max_tokens:
+                facts.append(text)
+                used += n
+        return facts
 
     def delete(self, key):
         """Cancella una chiave sotto 'user' o 'conversations'"""
-        section = "user" if key in self.data.get("user", {}) else \
-                  "conversations" if key in self.data.get("conversations", {}) else None
-        if section:
-            del self.data[section][key]
-            self.save()
+        with self._lock:
+            section = "user" if self._read(f"user.{key}") is not None else \
+                      "conversations" if self._read(f"conversations.{key}") is not None else None
+            if section:
+                delete_nested(self.data, f"{section}.{key}")
+                self._record([{"op": "delete", "path": f"{section}.{key}"}])
+
+    def _record(self, entries):
+        with self._lock:
+            self.data["system"]["updated_at"] = datetime.now().isoformat()
+            for entry in entries:
+                path = entry["path"]
+                if entry["op"] == "set":
+                    self.facts.set(path, entry["value"])
+                else:
+                    self.facts.remove(path)
+                # Una modifica rende superflue quelle in sospeso sullo stesso percorso o sotto di esso
+                for dirty in [d for d in self._dirty if d == path or d.startswith(path + ".")]:
+                    del self._dirty[dirty]
+                self._dirty[path] = entry
+            if len(self._dirty) >= MAX_DIRTY:
+                self._write_dirty()
+            else:
+                self._schedule_write()
+
+    def _schedule_write(self):
+        if self._flush_timer is None:
+            self._flush_timer = threading.Timer(FLUSH_DELAY, self._write_dirty)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def _write_dirty(self):
+        """Scrive nel backend le modifiche in sospeso, tutte in un solo gruppo"""
+        with self._lock:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            if self._dirty:
+                entries = list(self._dirty.values())
+                try:
+                    self.store.write(entries, self.data["system"]["updated_at"], self.data)
+                except Exception:
+                    # Le modifiche restano in sospeso e si riprova più tardi
+                    self._schedule_write()
+                    raise
+                self._dirty.clear()
 
     def save(self):
-        """Salva la memoria su disco"""
-        data_to_save = self.data.copy()
-        data_to_save["system"]["updated_at"] = datetime.now().isoformat()
-        with open(self.storage_key, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, indent=2, ensure_ascii=False)
+        """Salva tutta la memoria in un nuovo snapshot (di norma avviene da sé)"""
+        with self._lock:
+            self._write_dirty()
+            self.data["system"]["updated_at"] = datetime.now().isoformat()
+            self.store.compact(self.data)
+
+    def flush(self):
+        """Garantisce che le modifiche fatte finora siano su disco"""
+        with self._lock:
+            self._write_dirty()
+            self.store.sync()
 
     def is_enabled(self):
-        return self.data["system"].get("memory_enabled", True)
+        return self._read("system.memory_enabled", True)
 
     def clear(self):
         """Resetta completamente la memoria"""
-        if self.storage_key.exists():
-            os.remove(self.storage_key)
-        self.data = self.default_memory()
+        with self._lock:
+            self._dirty.clear()
+            self.store.clear()
+            self.load()
 
     def log_change(self, action, key, value):
         """Registra le modifiche (opzionale)"""
         log_entry = {
             "timestamp": datetime.now().isoformat(),
+            "user": self.user_id,
             "action": action,
             "key": key,
             "value_preview": str(value)[:50]
         }
-        log_file = MEMORY_DIR / "log.json"
-        logs = []
-        if log_file.exists():
-            try:
-                with open(log_file, 'r', encoding='utf-8') as f:
-                    logs = json.load(f)
-            except:
-                pass
-        logs.append(log_entry)
-        with open(log_file, 'w', encoding='utf-8') as f:
-            json.dump(logs[-100:], f, indent=2) 
\ No newline at end of file
+        get_change_log().append(log_entry)
+
+    def recent_changes(self, n=100):
+        """Ultime n modifiche di questo utente, dalla più vecchia alla più recente"""
+        return get_change_log().tail(n, user=self.user_id)
+
+# Gestori con modifiche forse in sospeso: vengono salvati alla chiusura del processo
+_managers = weakref.WeakSet()
+
+@atexit.register
+def _flush_all():
+    for manager in list(_managers):
+        try:
+            manager.flush()
+        except Exception:
+            pass
+
+_memories = {}
+_memories_lock = threading.Lock()
+
+def get_memory(user_id="default", backend=MEMORY_BACKEND) -> MemoryManager:
+    """Memoria dell'utente condivisa dalle sessioni del processo (un solo gestore per file)"""
+    with _memories_lock:
+        if user_id not in _memories:
+            _memories[user_id] = MemoryManager(user_id, backend)
+        return _memories[user_id]
+
+_change_log = None
+_change_log_lock = threading.Lock()
+
+def get_change_log() -> ChangeLog:
+    """Registro delle modifiche condiviso dal processo, aperto al primo utilizzo"""
+    global _change_log
+    with _change_log_lock:
+        if _change_log is None:
+            _change_log = ChangeLog()
+            atexit.register(_change_log.flush)
+        return _change_log
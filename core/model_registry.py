@@ -0,0 +1,146 @@
+# core/model_registry.py
+import os
+import threading
+import time
+import weakref
+
+from .local_llm import LocalLLM
+from .scheduler import GenerationScheduler
+
+# --- CONFIG ---
+IDLE_TIMEOUT = 600  # Secondi senza utilizzatori prima di scaricare un modello
+SWEEP_INTERVAL = 60
+# Conversazioni decodificate insieme. 1 = una richiesta alla volta sul contesto di LocalLLM,
+# che riusa il prefisso già valutato e lo stato del prompt di sistema salvato su disco.
+# Con valori maggiori il BatchEngine alloca un secondo contesto con una cache KV per
+# conversazione (più memoria): conviene solo con molti utenti contemporanei.
+N_PARALLEL = 1
+
+class ModelHandle:
+    """Riferimento condiviso a un modello caricato nel registro.
+
+    Il riferimento viene rilasciato con release() oppure automaticamente quando
+    l'handle viene raccolto dal garbage collector (es. sessione Streamlit chiusa)."""
+
+    def __init__(self, registry, key, entry):
+        self.key = key
+        self.llm = entry.llm
+        self.scheduler = entry.scheduler  # Tutte le generazioni passano da qui
+        self._finalizer = weakref.finalize(self, registry._release, key)
+
+    def release(self):
+        self._finalizer()
+
+    @property
+    def released(self):
+        return not self._finalizer.alive
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+def _batch_engine(llm, n_parallel):
+    """BatchEngine per il modello, o None se il batching non è disponibile"""
+    if n_parallel <= 1:
+        return None
+    try:
+        from .batch_engine import BatchEngine
+        return BatchEngine(llm, n_parallel=n_parallel)
+    except Exception:
+        # Versione di llama-cpp-python senza API batch o memoria insufficiente per la cache KV
+        return None
+
+class _Entry:
+    def __init__(self, llm, n_parallel=N_PARALLEL):
+        self.llm = llm
+        self.scheduler = GenerationScheduler(llm, engine=_batch_engine(llm, n_parallel))
+        self.refs = 0
+        self.last_used = time.monotonic()
+
+class ModelRegistry:
+    """Registro di processo: ogni GGUF viene caricato una sola volta e condiviso tra le sessioni"""
+
+    def __init__(self, idle_timeout=IDLE_TIMEOUT, loader=LocalLLM, n_parallel=N_PARALLEL):
+        self.idle_timeout = idle_timeout
+        self._loader = loader
+        self.n_parallel = n_parallel
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._loading = {}  # chiave -> Event, per non caricare due volte lo stesso modello
+        self._sweeper = None
+
+    @staticmethod
+    def _key(model_path, options):
+        return (os.path.abspath(str(model_path)),) + tuple(sorted(options.items()))
+
+    def acquire(self, model_path, **options) -> ModelHandle:
+        """Restituisce un handle al modello, caricandolo se necessario"""
+        key = self._key(model_path, options)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.refs += 1
+                    entry.last_used = time.monotonic()
+                    return ModelHandle(self, key, entry)
+                loading = self._loading.get(key)
+                if loading is None:
+                    loading = self._loading[key] = threading.Event()
+                    break
+            # Un'altra sessione sta già caricando questo modello: aspetta e riprova
+            loading.wait()
+        try:
+            llm = self._loader(model_path=str(model_path), **options)
+            with self._lock:
+                entry = self._entries[key] = _Entry(llm, self.n_parallel)
+                entry.refs += 1
+                self._start_sweeper()
+            return ModelHandle(self, key, entry)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            loading.set()
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.refs > 0:
+                entry.refs -= 1
+                entry.last_used = time.monotonic()
+
+    def unload_idle(self, max_idle=None):
+        """Scarica i modelli senza utilizzatori da più di max_idle secondi"""
+        max_idle = self.idle_timeout if max_idle is None else max_idle
+        now = time.monotonic()
+        with self._lock:
+            idle = [key for key, entry in self._entries.items()
+                    if entry.refs == 0 and now - entry.last_used >= max_idle]
+            unloaded = [self._entries.pop(key) for key in idle]
+        for entry in unloaded:
+            entry.scheduler.shutdown()
+        return len(unloaded)
+
+    def stats(self):
+        """Modelli caricati e numero di sessioni che li usano"""
+        with self._lock:
+            return {key[0]: entry.refs for key, entry in self._entries.items()}
+
+    def _start_sweeper(self):
+        if self._sweeper is not None and self._sweeper.is_alive():
+            return
+        self._sweeper = threading.Thread(target=self._sweep, name="model-registry-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep(self):
+        while True:
+            time.sleep(SWEEP_INTERVAL)
+            self.unload_idle()
+            with self._lock:
+                if not self._entries:
+                    self._sweeper = None
+                    return
+
+# Registro condiviso da tutte le sessioni del processo
+MODEL_REGISTRY = ModelRegistry()
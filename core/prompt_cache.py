@@ -0,0 +1,60 @@
+# core/prompt_cache.py
+import copy
+import hashlib
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+from .disk_cache import discard, evict, touch, write_atomic
+
+# --- CONFIG ---
+CACHE_DIR = Path("cache") / "prompt_states"
+MAX_CACHE_BYTES = 4 * 1024 ** 3  # 4 GB
+
+class PromptStateCache:
+    """Cache su disco degli stati valutati del modello (KV cache di un prefisso).
+
+    Le voci sono indicizzate da percorso del modello, mtime, n_ctx e hash dei token
+    del prefisso; quando la cartella supera max_bytes si eliminano le meno usate."""
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def key(self, model_path, n_ctx, tokens) -> str:
+        """Chiave di uno stato: cambia se il file del modello viene sostituito"""
+        model_path = os.path.abspath(model_path)
+        mtime = os.stat(model_path).st_mtime_ns
+        prefix_hash = hashlib.sha256(np.asarray(tokens, dtype=np.int32).tobytes()).hexdigest()
+        raw = f"{model_path}|{mtime}|{n_ctx}|{prefix_hash}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key) -> Path:
+        return self.cache_dir / f"{key}.state"
+
+    def get(self, key):
+        """Restituisce lo stato salvato o None"""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Voce corrotta o di una versione incompatibile
+            discard(path)
+            return None
+        touch(path)
+        return state
+
+    def put(self, key, state):
+        """Salva uno stato in modo atomico e applica il limite di dimensione"""
+        state = copy.copy(state)
+        # I logit salvati non servono: dopo load_state llama.cpp rivaluta l'ultimo token.
+        # Una riga di zeri basta (load_state la ripete per broadcasting) e risparmia centinaia di MB.
+        state.scores = np.zeros((1, state.scores.shape[-1]), dtype=np.single)
+        write_atomic(self._path(key), lambda f: pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL))
+        evict(self.cache_dir, "*.state", self.max_bytes)
@@ -0,0 +1,296 @@
+# core/scheduler.py
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+
+# --- CONFIG ---
+PRIORITY_CHAT = 0       # Messaggi brevi della chat: serviti per primi
+PRIORITY_RESEARCH = 10  # Riassunti @deepsearch e altri lavori lunghi
+PRIORITY_BACKGROUND = 20  # Manutenzione in background (es. riassunto della conversazione)
+MAX_QUEUE = 32
+WORKER_IDLE_TIMEOUT = 30  # Secondi prima che il worker inattivo termini
+POLL_INTERVAL = 0.5
+
+_DONE = object()
+
+class QueueFullError(RuntimeError):
+    """La coda di generazione è piena: il client deve riprovare più tardi"""
+
+class GenerationJob:
+    """Richiesta di generazione in coda; si consuma con stream() o result()"""
+
+    def __init__(self, scheduler, seq, prompt, session_id, priority, params):
+        self.scheduler = scheduler
+        self.seq = seq
+        self.prompt = prompt
+        self.session_id = session_id
+        self.priority = priority
+        self.params = params
+        self.state = "queued"  # queued -> running -> done | cancelled | failed
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self._deltas = queue.Queue()
+        self._cancel = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """Annulla la richiesta: la toglie dalla coda o interrompe la generazione"""
+        self._cancel.set()
+        self.scheduler._discard(self)
+
+    def status(self) -> dict:
+        """Stato, posizione in coda (0 = in esecuzione) e attesa stimata in secondi"""
+        position, wait = self.scheduler._position(self)
+        return {"state": self.state, "position": position, "estimated_wait": wait}
+
+    def stream(self, on_wait=None, deadline=None):
+        """Restituisce i delta di testo man mano che arrivano.
+
+        Finché la richiesta è in coda, on_wait(position, estimated_wait) viene chiamato
+        periodicamente. Se il consumatore abbandona lo stream la richiesta viene annullata,
+        così come oltre deadline (istante di time.monotonic()), con TimeoutError."""
+        try:
+            while True:
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise TimeoutError("Tempo scaduto per la generazione")
+                try:
+                    item = self._deltas.get(timeout=POLL_INTERVAL)
+                except queue.Empty:
+                    if on_wait is not None and self.state == "queued":
+                        position, wait = self.scheduler._position(self)
+                        on_wait(position, wait)
+                    continue
+                if item is _DONE:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            if self.state in ("queued", "running"):
+                self.cancel()
+
+    def result(self, on_wait=None, deadline=None) -> str:
+        return "".join(self.stream(on_wait=on_wait, deadline=deadline)).strip()
+
+class GenerationScheduler:
+    """Coda di generazione davanti a un LocalLLM condiviso.
+
+    Un solo worker esegue le richieste una alla volta. La coda è limitata (oltre
+    max_queue richieste in attesa submit() solleva QueueFullError), ordinata per
+    priorità e, a parità di priorità, a turno tra le sessioni."""
+
+    def __init__(self, llm, max_queue=MAX_QUEUE, engine=None):
+        self.llm = llm
+        self.max_queue = max_queue
+        # Con un BatchEngine il worker decodifica più richieste insieme
+        self.engine = engine
+        self.capacity = engine.n_parallel if engine is not None else 1
+        self._cond = threading.Condition()
+        self._pending = {}         # priorità -> sessione -> deque di job
+        self._last_served = {}     # sessione -> ultimo avvio servito
+        self._running = []
+        self._worker = None
+        self._seq = itertools.count()
+        self._avg_duration = 5.0  # Media mobile della durata di una richiesta
+        self._closed = False
+
+    def submit(self, prompt, session_id="default", priority=PRIORITY_CHAT, **params) -> GenerationJob:
+        """Accoda una richiesta; params vengono passati a llm.generate_stream"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Scheduler chiuso")
+            if self.queue_depth() >= self.max_queue:
+                raise QueueFullError(f"Coda piena ({self.max_queue} richieste in attesa)")
+            job = GenerationJob(self, next(self._seq), prompt, session_id, priority, params)
+            self._pending.setdefault(priority, {}).setdefault(session_id, deque()).append(job)
+            self._ensure_worker()
+            self._cond.notify()
+            return job
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return sum(len(jobs) for sessions in self._pending.values() for jobs in sessions.values())
+
+    def shutdown(self):
+        """Annulla tutte le richieste e ferma il worker"""
+        with self._cond:
+            self._closed = True
+            jobs = [job for sessions in self._pending.values() for jobs in sessions.values() for job in jobs]
+            jobs.extend(self._running)
+            worker_stopped = self._worker is None
+            self._cond.notify_all()
+        for job in jobs:
+            job.cancel()
+        if self.engine is not None and worker_stopped:
+            self.engine.close()
+
+    # --- Ordinamento ---
+
+    def _order(self):
+        """Job in attesa nell'ordine in cui verrebbero serviti (senza modificare la coda)"""
+        order = []
+        last_served = dict(self._last_served)
+        tick = time.monotonic()
+        for priority in sorted(self._pending):
+            sessions = {sid: list(jobs) for sid, jobs in self._pending[priority].items() if jobs}
+            while sessions:
+                # Turno alla sessione servita meno di recente
+                sid = min(sessions, key=lambda s: (last_served.get(s, -1.0), sessions[s][0].seq))
+                order.append(sessions[sid].pop(0))
+                tick += 1
+                last_served[sid] = tick
+                if not sessions[sid]:
+                    del sessions[sid]
+        return order
+
+    def _next_job(self):
+        for priority in sorted(self._pending):
+            sessions = self._pending[priority]
+            candidates = [sid for sid, jobs in sessions.items() if jobs]
+            if not candidates:
+                continue
+            sid = min(candidates, key=lambda s: (self._last_served.get(s, -1.0), sessions[s][0].seq))
+            job = sessions[sid].popleft()
+            if not sessions[sid]:
+                del sessions[sid]
+            if not sessions:
+                del self._pending[priority]
+            self._last_served[sid] = time.monotonic()
+            return job
+        return None
+
+    def _position(self, job):
+        with self._cond:
+            if job.state != "queued":
+                return 0, 0.0
+            order = self._order()
+            position = order.index(job) + 1 if job in order else 0
+            # Si libera uno slot ogni avg_duration / capacity secondi circa
+            wait = (position - 1) * self._avg_duration / self.capacity
+            if self._running and len(self._running) >= self.capacity:
+                elapsed = max(time.monotonic() - running.started_at for running in self._running)
+                wait += max(self._avg_duration - elapsed, 0.0)
+            return position, wait
+
+    def _discard(self, job):
+        with self._cond:
+            sessions = self._pending.get(job.priority, {})
+            jobs = sessions.get(job.session_id)
+            if jobs and job in jobs:
+                jobs.remove(job)
+                job.state = "cancelled"
+                job._deltas.put(_DONE)
+
+    # --- Worker ---
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+            self._worker.start()
+
+    def _start(self, job):
+        self._running.append(job)
+        job.state = "running"
+        job.started_at = time.monotonic()
+
+    def _finish(self, job):
+        with self._cond:
+            self._running.remove(job)
+            duration = time.monotonic() - job.started_at
+            self._avg_duration = 0.8 * self._avg_duration + 0.2 * duration
+
+    def _wait_for_job(self):
+        """Prossimo job da servire; None se il worker deve terminare"""
+        job = self._next_job()
+        while job is None and not self._running:
+            woken = self._cond.wait(WORKER_IDLE_TIMEOUT)
+            job = self._next_job()
+            if job is None and (self._closed or not woken):
+                self._worker = None
+                return None
+        return job
+
+    def _run(self):
+        if self.engine is not None:
+            return self._run_batched()
+        while True:
+            with self._cond:
+                job = self._wait_for_job()
+                if job is None:
+                    return
+                self._start(job)
+            try:
+                self._execute(job)
+            finally:
+                self._finish(job)
+
+    def _execute(self, job):
+        stream = self.llm.generate_stream(job.prompt, **job.params)
+        try:
+            for delta in stream:
+                if job.cancelled:
+                    job.state = "cancelled"
+                    break
+                job._deltas.put(delta)
+            else:
+                job.state = "done"
+        except Exception as e:
+            job.state = "failed"
+            job._deltas.put(e)
+        finally:
+            stream.close()
+            job._deltas.put(_DONE)
+
+    def _run_batched(self):
+        engine = self.engine
+        while True:
+            with self._cond:
+                # Le nuove richieste entrano nel batch appena si libera uno slot
+                while engine.has_free_slot():
+                    job = self._wait_for_job() if engine.idle() else self._next_job()
+                    if job is None:
+                        break
+                    self._start(job)
+                    try:
+                        # Chat, riassunti e ricerche della stessa sessione hanno cache KV distinte
+                        engine.add(job, job.prompt, owner=(job.session_id, job.priority), **job.params)
+                    except Exception as e:
+                        job.state = "failed"
+                        job._deltas.put(e)
+                        job._deltas.put(_DONE)
+                        self._running.remove(job)
+                if engine.idle():
+                    if self._worker is None:
+                        if self._closed:
+                            engine.close()
+                        return
+                    continue
+            for job in list(self._running):
+                if job.cancelled:
+                    # La cache contiene solo token già valutati: resta utile al prossimo turno
+                    engine.remove(job, keep=True)
+                    job.state = "cancelled"
+                    job._deltas.put(_DONE)
+                    self._finish(job)
+            try:
+                events = engine.step()
+            except Exception as e:
+                for job in list(self._running):
+                    engine.remove(job)
+                    job.state = "failed"
+                    job._deltas.put(e)
+                    job._deltas.put(_DONE)
+                    self._finish(job)
+                continue
+            for job, delta, finished in events:
+                if delta:
+                    job._deltas.put(delta)
+                if finished:
+                    job.state = "done"
+                    job._deltas.put(_DONE)
+                    self._finish(job)
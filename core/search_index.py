@@ -0,0 +1,389 @@
+# core/search_index.py
+import atexit
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from . import bm25
+from .bm25 import tokenize
+
+# --- CONFIG ---
+INDEX_DIR = Path("memory") / "search_index"
+FLUSH_DOCS = 64         # Documenti tenuti in memoria prima di scrivere un segmento su disco
+MERGE_FACTOR = 4        # Segmenti di dimensione simile fusi insieme
+MAX_DOC_CHARS = 20000   # Testo indicizzato per documento
+SNIPPET_CHARS = 200
+
+# Un record per documento, nell'ordine di inserimento (l'indice del record è l'id del documento)
+DOC_DTYPE = np.dtype([
+    ("offset", "<u8"),   # Posizione del testo in docs.dat
+    ("size", "<u4"),     # Byte del record in docs.dat
+    ("length", "<u4"),   # Numero di termini (per BM25)
+    ("key", "<u8"),      # Hash di proprietario e chiave del documento (es. l'URL di una pagina)
+    ("owner", "<u8"),    # Hash del proprietario: la ricerca vede solo i suoi documenti
+    ("digest", "<u8"),   # Hash del testo: stesso documento, niente reindicizzazione
+    ("deleted", "u1"),
+])
+DELETED_OFFSET = DOC_DTYPE.fields["deleted"][1]
+POSTING_DTYPE = np.dtype([("doc", "<u4"), ("tf", "<u4")])
+KEY_DTYPE = np.dtype([("key", "<u8"), ("doc", "<u4")])
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "little")
+
+def _key_hash(owner: str, key: str) -> int:
+    # La stessa chiave (es. l'URL di una pagina) di due proprietari resta in due documenti
+    return _hash(f"{owner}\0{key}")
+
+def _write_atomic(path: Path, data: bytes):
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _memmap(path: Path, dtype) -> np.ndarray:
+    """File mappato in memoria in sola lettura (array vuoto se il file è vuoto)"""
+    size = path.stat().st_size if path.exists() else 0
+    count = size // np.dtype(dtype).itemsize
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+class _Segment:
+    """Segmento immutabile dell'indice invertito, letto tramite mmap.
+
+    hash: hash dei termini in ordine crescente; ptr: inizio delle liste di ciascun
+    termine in post (più un elemento finale); post: coppie (documento, frequenza);
+    keys: coppie (hash della chiave, documento) in ordine di chiave, per trovare un
+    documento dalla sua chiave senza scorrere docs.meta."""
+
+    def __init__(self, directory: Path, number: int):
+        self.number = number
+        self.paths = [directory / f"seg_{number}.{ext}" for ext in ("hash", "ptr", "post", "keys")]
+        self.hashes = _memmap(self.paths[0], "<u8")
+        self.ptr = _memmap(self.paths[1], "<u8")
+        self.postings = _memmap(self.paths[2], POSTING_DTYPE)
+        self.keys = _memmap(self.paths[3], KEY_DTYPE)
+
+    @classmethod
+    def write(cls, directory: Path, number: int, hashes: np.ndarray, ptr: np.ndarray, postings: np.ndarray,
+              keys: np.ndarray):
+        for ext, array in (("hash", hashes), ("ptr", ptr), ("post", postings), ("keys", keys)):
+            _write_atomic(directory / f"seg_{number}.{ext}", array.tobytes())
+        return cls(directory, number)
+
+    def lookup(self, term_hash: int) -> np.ndarray:
+        i = np.searchsorted(self.hashes, term_hash)
+        if i >= len(self.hashes) or self.hashes[i] != term_hash:
+            return self.postings[:0]
+        return self.postings[self.ptr[i]:self.ptr[i + 1]]
+
+    def docs_with_key(self, key_hash: int) -> np.ndarray:
+        start = np.searchsorted(self.keys["key"], key_hash, side="left")
+        end = np.searchsorted(self.keys["key"], key_hash, side="right")
+        return self.keys["doc"][start:end]
+
+    def expanded(self):
+        """(hash del termine, documento, frequenza) per ogni posting, per la fusione"""
+        counts = np.diff(self.ptr.astype(np.int64))
+        return np.repeat(np.asarray(self.hashes), counts), np.asarray(self.postings)
+
+    def remove(self):
+        for path in self.paths:
+            path.unlink(missing_ok=True)
+
+class SearchIndex:
+    """Indice full-text su disco per la ricerca offline (@cerca).
+
+    I testi stanno in docs.dat (solo aggiunte) e i metadati in docs.meta, un record
+    fisso per documento. Le liste dei documenti per termine (posting) stanno in
+    segmenti immutabili letti tramite mmap: la memoria occupata non cresce con il
+    corpus. I nuovi documenti si accumulano in memoria e ogni FLUSH_DOCS diventano
+    un segmento; MERGE_FACTOR segmenti di dimensione simile vengono fusi in uno più
+    grande (fusione a livelli): ogni posting viene riscritto una volta per livello e le
+    fusioni grandi sono rare. I punteggi sono BM25.
+
+    Ogni documento appartiene a un proprietario (utente o sessione): chiavi e
+    risultati di ricerca sono separati per proprietario."""
+
+    def __init__(self, directory=INDEX_DIR):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._data_path = self.directory / "docs.dat"
+        self._meta_path = self.directory / "docs.meta"
+        self._manifest_path = self.directory / "manifest.json"
+        manifest = {"segments": [], "indexed": 0, "next_segment": 0}
+        if self._manifest_path.exists():
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                manifest.update(json.load(f))
+        self._segments = [_Segment(self.directory, n) for n in manifest["segments"]]
+        self._indexed = manifest["indexed"]
+        self._next_segment = manifest["next_segment"]
+        # Un record incompleto (interruzione durante la scrittura) viene scartato
+        meta_size = self._meta_path.stat().st_size if self._meta_path.exists() else 0
+        if meta_size % DOC_DTYPE.itemsize:
+            with open(self._meta_path, "r+b") as f:
+                f.truncate(meta_size - meta_size % DOC_DTYPE.itemsize)
+        self._data = open(self._data_path, "ab")
+        self._meta_file = open(self._meta_path, "ab")
+        self._reader = os.open(self._data_path, os.O_RDONLY)
+        self._meta = None
+        meta = self._meta_view()
+        self._n_docs = len(meta)
+        alive = meta["deleted"] == 0
+        self._n_alive = int(np.count_nonzero(alive))
+        self._total_length = int(meta["length"][alive].sum()) if self._n_docs else 0
+        self._buffer = {}  # hash del termine -> [(documento, frequenza)]
+        self._buffer_keys = {}  # hash della chiave -> [documento], per i documenti non ancora in un segmento
+        self._buffered = 0
+        # Documenti salvati ma non ancora in un segmento: si reindicizzano dal testo
+        for doc_id in range(self._indexed, self._n_docs):
+            self._buffer_postings(doc_id, int(meta["key"][doc_id]), Counter(tokenize(self._read(doc_id)["text"])))
+
+    # --- Documenti ---
+
+    def _meta_view(self) -> np.ndarray:
+        # Si rimappa solo quando servono record aggiunti dopo l'ultima mappatura
+        if self._meta is None or len(self._meta) < self._n_docs:
+            self._meta = _memmap(self._meta_path, DOC_DTYPE)
+        return self._meta
+
+    def _read(self, doc_id: int) -> Dict:
+        record = self._meta_view()[doc_id]
+        data = os.pread(self._reader, int(record["size"]), int(record["offset"]))
+        return json.loads(data)
+
+    def __len__(self):
+        return self._n_alive
+
+    def add(self, key: str, text: str, kind: str = "doc", title: str = "", unique: bool = False,
+            owner: str = "") -> Optional[int]:
+        """Indicizza un documento; una chiave già presente sostituisce il documento precedente.
+
+        Con unique=True il chiamante garantisce che la chiave è nuova (es. i messaggi della
+        chat) e il controllo dei duplicati viene saltato. Restituisce l'id del documento
+        (None se il testo non contiene parole)."""
+        text = text[:MAX_DOC_CHARS]
+        terms = Counter(tokenize(text))
+        if not terms:
+            return None
+        key_hash, digest = _key_hash(owner, key), _hash(text)
+        with self._lock:
+            if not unique:
+                meta = self._meta_view()
+                for doc_id in self._docs_with_key(key_hash):
+                    if meta["digest"][doc_id] == digest:
+                        return int(doc_id)  # Già indicizzato così com'è
+                    self._mark_deleted(int(doc_id))
+            record = json.dumps({"key": key, "owner": owner, "kind": kind, "title": title, "text": text},
+                                ensure_ascii=False).encode("utf-8") + b"\n"
+            offset = self._data.tell()
+            self._data.write(record)
+            self._data.flush()
+            length = sum(terms.values())
+            self._meta_file.write(np.array([(offset, len(record), length, key_hash, _hash(owner), digest, 0)],
+                                           dtype=DOC_DTYPE).tobytes())
+            self._meta_file.flush()
+            doc_id = self._n_docs
+            self._n_docs += 1
+            self._n_alive += 1
+            self._total_length += length
+            self._buffer_postings(doc_id, key_hash, terms)
+            if self._buffered >= FLUSH_DOCS:
+                self._flush()
+            return doc_id
+
+    def delete(self, key: str, owner: str = "") -> int:
+        """Rimuove dai risultati i documenti del proprietario con questa chiave; restituisce quanti"""
+        key_hash = _key_hash(owner, key)
+        with self._lock:
+            doc_ids = self._docs_with_key(key_hash)
+            for doc_id in doc_ids:
+                self._mark_deleted(int(doc_id))
+            return len(doc_ids)
+
+    def _mark_deleted(self, doc_id: int):
+        # I posting restano nei segmenti (vengono scartati alla fusione); basta il flag
+        with open(self._meta_path, "r+b") as f:
+            f.seek(doc_id * DOC_DTYPE.itemsize + DELETED_OFFSET)
+            f.write(b"\x01")
+        self._total_length -= int(self._meta_view()["length"][doc_id])
+        self._n_alive -= 1
+
+    def _docs_with_key(self, key_hash: int) -> np.ndarray:
+        """Documenti non cancellati con questa chiave: ricerca binaria nelle tabelle dei segmenti"""
+        parts = [segment.docs_with_key(key_hash) for segment in self._segments]
+        parts.append(np.array(self._buffer_keys.get(key_hash, []), dtype="<u4"))
+        docs = np.concatenate(parts).astype(np.int64)
+        if not len(docs):
+            return docs
+        return docs[self._meta_view()["deleted"][docs] == 0]
+
+    # --- Segmenti ---
+
+    def _buffer_postings(self, doc_id: int, key_hash: int, terms: Counter):
+        for term, tf in terms.items():
+            self._buffer.setdefault(_hash(term), []).append((doc_id, tf))
+        self._buffer_keys.setdefault(key_hash, []).append(doc_id)
+        self._buffered += 1
+
+    def flush(self):
+        """Scrive su disco i documenti ancora in memoria"""
+        with self._lock:
+            if self._buffered:
+                self._flush()
+
+    def _flush(self):
+        hashes = np.array(sorted(self._buffer), dtype="<u8")
+        lists = [self._buffer[int(h)] for h in hashes]
+        ptr = np.zeros(len(lists) + 1, dtype="<u8")
+        ptr[1:] = np.cumsum([len(postings) for postings in lists])
+        postings = np.array([p for postings in lists for p in postings], dtype=POSTING_DTYPE)
+        keys = np.array([(key_hash, doc_id) for key_hash in sorted(self._buffer_keys)
+                         for doc_id in self._buffer_keys[key_hash]], dtype=KEY_DTYPE)
+        self._segments.append(_Segment.write(self.directory, self._next_segment, hashes, ptr, postings, keys))
+        self._next_segment += 1
+        self._indexed = self._n_docs
+        self._buffer = {}
+        self._buffer_keys = {}
+        self._buffered = 0
+        self._save_manifest()
+        self._merge_tiers()
+
+    @staticmethod
+    def _tier(segment: "_Segment") -> int:
+        """Livello del segmento: MERGE_FACTOR volte più posting del livello precedente"""
+        return int(math.log(max(len(segment.postings), 1), MERGE_FACTOR))
+
+    def _merge_tiers(self):
+        """Fonde gli ultimi MERGE_FACTOR segmenti finché hanno lo stesso livello.
+
+        Ogni fusione riscrive solo segmenti di dimensione simile: un posting viene
+        riscritto una volta per livello e nessuna aggiunta paga per tutto il corpus."""
+        while len(self._segments) >= MERGE_FACTOR:
+            tail = self._segments[-MERGE_FACTOR:]
+            if len({self._tier(segment) for segment in tail}) > 1:
+                break
+            self._merge(tail)
+
+    def _merge(self, segments: List["_Segment"]):
+        """Fonde i segmenti in uno, scartando i documenti cancellati"""
+        parts = [segment.expanded() for segment in segments]
+        hashes = np.concatenate([h for h, _ in parts])
+        postings = np.concatenate([p for _, p in parts])
+        deleted = self._meta_view()["deleted"]
+        alive = deleted[postings["doc"]] == 0
+        hashes, postings = hashes[alive], postings[alive]
+        order = np.lexsort((postings["doc"], hashes))
+        hashes, postings = hashes[order], postings[order]
+        unique, starts = np.unique(hashes, return_index=True)
+        ptr = np.append(starts, len(hashes)).astype("<u8")
+        keys = np.concatenate([np.asarray(segment.keys) for segment in segments])
+        keys = keys[deleted[keys["doc"]] == 0]
+        keys = keys[np.lexsort((keys["doc"], keys["key"]))]
+        merged = _Segment.write(self.directory, self._next_segment, unique, ptr, postings, keys)
+        self._next_segment += 1
+        self._segments = [segment for segment in self._segments if segment not in segments] + [merged]
+        self._save_manifest()
+        for segment in segments:
+            segment.remove()
+
+    def _save_manifest(self):
+        manifest = {
+            "segments": [segment.number for segment in self._segments],
+            "indexed": self._indexed,
+            "next_segment": self._next_segment,
+        }
+        _write_atomic(self._manifest_path, json.dumps(manifest).encode("utf-8"))
+
+    # --- Ricerca ---
+
+    def _postings(self, term_hash: int) -> np.ndarray:
+        parts = [segment.lookup(term_hash) for segment in self._segments]
+        if term_hash in self._buffer:
+            parts.append(np.array(self._buffer[term_hash], dtype=POSTING_DTYPE))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=POSTING_DTYPE)
+
+    def search(self, query: str, k: int = 5, kinds: Optional[List[str]] = None, owner: str = "") -> List[Dict]:
+        """I k documenti del proprietario più rilevanti per la query (BM25), con un estratto
+        attorno ai termini cercati"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            meta = self._meta_view()
+            n_docs = self._n_alive
+            if not n_docs:
+                return []
+            avgdl = max(self._total_length / n_docs, 1.0)
+            doc_parts, score_parts = [], []
+            for term in terms:
+                postings = self._postings(_hash(term))
+                if not len(postings):
+                    continue
+                docs = postings["doc"].astype(np.int64)
+                tf = postings["tf"].astype(np.float64)
+                doc_parts.append(docs)
+                # I posting dei documenti cancellati restano fino alla fusione: df può superare n_docs
+                score_parts.append(bm25.weight(tf, bm25.idf(max(n_docs, len(docs)), len(docs)), meta["length"][docs], avgdl))
+            if not doc_parts:
+                return []
+            docs, inverse = np.unique(np.concatenate(doc_parts), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(score_parts))
+            visible = (meta["deleted"][docs] == 0) & (meta["owner"][docs] == _hash(owner))
+            docs, scores = docs[visible], scores[visible]
+            order = np.argsort(-scores, kind="stable")
+            results = []
+            for i in order:
+                doc = self._read(int(docs[i]))
+                if kinds and doc["kind"] not in kinds:
+                    continue
+                results.append({
+                    "key": doc["key"],
+                    "kind": doc["kind"],
+                    "title": doc["title"],
+                    "score": float(scores[i]),
+                    "snippet": snippet(doc["text"], terms),
+                })
+                if len(results) >= k:
+                    break
+            return results
+
+    def close(self):
+        with self._lock:
+            if self._data.closed:
+                return
+            self.flush()
+            self._data.close()
+            self._meta_file.close()
+            os.close(self._reader)
+
+def snippet(text: str, terms: List[str], size: int = SNIPPET_CHARS) -> str:
+    """Parte del testo attorno alla prima occorrenza di uno dei termini"""
+    match = re.search(r"\b(?:" + "|".join(map(re.escape, terms)) + r")\b", text, re.IGNORECASE)
+    start = max(0, match.start() - size // 4) if match else 0
+    excerpt = " ".join(text[start:start + size].split())
+    return ("…" if start else "") + excerpt + ("…" if start + size < len(text) else "")
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index() -> SearchIndex:
+    """Indice di ricerca locale del processo, aperto al primo utilizzo"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SearchIndex()
+            atexit.register(_index.close)
+        return _index
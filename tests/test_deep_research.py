@@ -0,0 +1,95 @@
+# tests/test_deep_research.py
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from bs4 import BeautifulSoup
+
+from core.async_worker import get_worker
+from core.deep_research import DeepResearchCore, close_session, search_duckduckgo
+
+PAGES = {
+    "/gatti": "<html><body><nav>menu</nav><p>Il gatto domestico dorme fino a sedici ore al giorno.</p>"
+              "<p>I gatti comunicano con le fusa.</p></body></html>",
+    "/cani": "<html><body><p>Il cane è stato addomesticato prima del gatto.</p></body></html>",
+}
+
+class _Handler(BaseHTTPRequestHandler):
+    """Motore di ricerca e siti finti: i risultati puntano a 127.0.0.1 e localhost (due domini)"""
+
+    def _results(self):
+        port = self.server.server_address[1]
+        return ("<html><body><main>"
+                f'<a href="http://127.0.0.1:{port}/gatti">Gatti</a>'
+                f'<a href="http://localhost:{port}/cani">Cani</a>'
+                "</main></body></html>")
+
+    def _send(self, status, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.startswith("/search"):
+            self._send(200, self._results())
+        elif self.path in PAGES:
+            self._send(200, PAGES[self.path])
+        else:
+            self._send(404, "")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._send(200, self._results())
+
+    def log_message(self, *args):
+        pass
+
+async def search_local(query, session, engine):
+    """Parser di prova: i link dentro <main>, come search_brave"""
+    async with session.get(engine["url"], params={"q": query}) as response:
+        soup = BeautifulSoup(await response.text(), "html.parser")
+    return [{"title": a.get_text(strip=True), "url": a["href"]} for a in soup.select("main a")]
+
+class DeepResearchOfflineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        get_worker().run(close_session(), timeout=5)
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def _research(self, engines):
+        core = DeepResearchCore(engines=engines, cache=None, search_deadline=5, fetch_deadline=5, total_deadline=30)
+        events = list(core.research_stream("quanto dorme il gatto"))
+        self.assertEqual(events[-1]["stage"], "done")
+        return events[-1]["result"]
+
+    def test_engine_with_own_parser(self):
+        result = self._research({"locale": {"url": f"{self.base}/search", "parser": search_local, "timeout": 5}})
+        self.assertEqual(result["count"], 2)
+        # La pagina sui gatti è la più pertinente; il menu non fa parte del testo
+        self.assertTrue(result["results"][0]["url"].endswith("/gatti"))
+        self.assertNotIn("menu", result["results"][0]["text"])
+        self.assertIn("sedici ore", result["summary"])
+        self.assertEqual({p["source"] for p in result["passages"]}, {1, 2})
+
+    def test_duckduckgo_parser_keeps_http_links(self):
+        engine = {"url": f"{self.base}/html/", "params": {"q": ""}, "parser": search_duckduckgo, "timeout": 5}
+        result = self._research({"ddg-locale": engine})
+        self.assertEqual(sorted(p["url"].rsplit("/", 1)[1] for p in result["results"]), ["cani", "gatti"])
+
+    def test_engine_without_parser_is_skipped(self):
+        result = self._research({"sconosciuto": {"url": f"{self.base}/search"}})
+        self.assertEqual(result["count"], 0)
+        self.assertEqual(DeepResearchCore.format(result), "❌ Nessun risultato trovato per: _quanto dorme il gatto_")
+
+if __name__ == "__main__":
+    unittest.main()